@@ -0,0 +1,206 @@
+"""Command line interface to the NOIRLab Astro Data Archive.
+
+Output is written as it arrives so the commands can be used in shell
+pipelines. EXAMPLES:
+  echo '{"outfields":["md5sum"],"search":[["instrument","decam"]]}' \\
+     | ada find --limit 20 | jq -r .md5sum | ada fetch -o /tmp/fits
+  ada count spec.json --rectype hdu
+  ada find spec.json --format csv | head
+"""
+# Python Standard Library
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+# Local Packages
+# (ada.client is imported on first use so that "--help" and argument
+#  errors never pay for importing "requests" or for contacting the Server.)
+# External Packages
+# <none>
+
+def _client(args):
+    from ada.client import AdaClient, _PROD
+    return AdaClient(url=args.url or _PROD,
+                     verbose=args.verbose,
+                     hedge=args.hedge,
+                     email=args.email,
+                     password=os.environ.get('ADA_PASSWORD'))
+
+
+def _read_jspec(filename):
+    if filename == '-':
+        if sys.stdin.isatty():
+            raise Exception('No search spec. Give a file containing one, '
+                            'or pipe one to stdin.')
+        text = sys.stdin.read()
+    else:
+        with open(filename) as f:
+            text = f.read()
+    if text.strip() == '':
+        source = 'stdin' if filename == '-' else f'"{filename}"'
+        raise Exception(f'Search spec in {source} is empty.')
+    return json.loads(text)
+
+
+def _md5sums(stream):
+    """Generate md5sums from lines of STREAM. Only the first whitespace
+    separated word of each line is used; blank and '#' lines are skipped."""
+    for line in stream:
+        words = line.split()
+        if len(words) == 0 or words[0].startswith('#'):
+            continue
+        yield words[0]
+
+
+def find(args):
+    jspec = _read_jspec(args.jspec)
+    with _client(args) as client:
+        writer = None
+        for info, rows in client.find_pages(jspec,
+                                            rectype=args.rectype,
+                                            pagesize=args.pagesize,
+                                            limit=args.limit,
+                                            sort=args.sort):
+            if args.format == 'csv':
+                if writer is None:
+                    writer = csv.DictWriter(sys.stdout,
+                                            fieldnames=list(rows[0].keys()),
+                                            extrasaction='ignore')
+                    writer.writeheader()
+                writer.writerows(rows)
+            else: # 'ndjson'
+                for row in rows:
+                    sys.stdout.write(json.dumps(row) + '\n')
+            sys.stdout.flush()
+    return 0
+
+
+def count(args):
+    jspec = _read_jspec(args.jspec)
+    with _client(args) as client:
+        print(client.count(jspec, rectype=args.rectype))
+    return 0
+
+
+def fetch(args):
+    client = _client(args)
+    os.makedirs(args.outdir, exist_ok=True)
+    hdu = args.hdu
+
+    def get(md5sum):
+        outfile = os.path.join(args.outdir, f'{md5sum}{args.suffix}')
+        client.retrieve(md5sum, outfile, hdu=hdu)
+        return outfile
+
+    # Never hold more than a few futures per worker so that memory stays
+    # bounded no matter how many md5sums arrive on stdin.
+    maxpending = 2 * args.jobs
+    status = 0
+    pending = dict()  # future -> md5sum
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        def drain(return_when):
+            nonlocal status
+            done, _ = wait(pending, return_when=return_when)
+            for fut in done:
+                md5sum = pending.pop(fut)
+                try:
+                    outfile = fut.result()
+                except Exception as err:
+                    print(f'ERROR: {md5sum}: {err}', file=sys.stderr)
+                    status = 1
+                else:
+                    sys.stdout.write(outfile + '\n')
+                    sys.stdout.flush()
+        try:
+            for md5sum in _md5sums(sys.stdin):
+                if len(pending) >= maxpending:
+                    drain(FIRST_COMPLETED)
+                pending[pool.submit(get, md5sum)] = md5sum
+            while pending:
+                drain(FIRST_COMPLETED)
+        except BaseException:
+            for fut in pending:
+                fut.cancel()
+            raise
+    return status
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='ada',
+        description='Query and retrieve from the NOIRLab Astro Data Archive',
+        epilog=('Set ADA_PASSWORD in the environment to go with --email '
+                'when retrieving proprietary files.'))
+    parser.add_argument('--url', action='append',
+                        help=('Archive server to use (default: production). '
+                              'Repeat to give equivalent servers; the '
+                              'fastest reachable one is used.'))
+    parser.add_argument('--hedge', action='store_true',
+                        help=('Resend slow searches to the next fastest '
+                              'server (needs more than one --url)'))
+    parser.add_argument('--email',
+                        help='PI email. Only needed for proprietary files.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Output more than just the results')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True  # "required" argument needs Python 3.7
+
+    sp = subparsers.add_parser(
+        'find', help='Stream metadata rows matching a search spec')
+    sp.add_argument('jspec', nargs='?', default='-',
+                    help='File containing JSON search spec (default: stdin)')
+    sp.add_argument('--rectype', choices=['file', 'hdu'], default='file')
+    sp.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    sp.add_argument('--limit', type=int, default=None,
+                    help='Maximum number of rows to output (default: all)')
+    sp.add_argument('--pagesize', type=int, default=1000,
+                    help='Number of rows requested from Server at a time')
+    sp.add_argument('--sort', default=None,
+                    help=('Comma separated fields to sort by. Must be unique '
+                          'per record (default: md5sum for files, '
+                          'archive_filename,hdu_idx for HDUs)'))
+    sp.set_defaults(func=find)
+
+    sp = subparsers.add_parser(
+        'count', help='Output number of records matching a search spec')
+    sp.add_argument('jspec', nargs='?', default='-',
+                    help='File containing JSON search spec (default: stdin)')
+    sp.add_argument('--rectype', choices=['file', 'hdu'], default='file')
+    sp.set_defaults(func=count)
+
+    sp = subparsers.add_parser(
+        'fetch', help='Download files whose md5sums are read from stdin')
+    sp.add_argument('-o', '--outdir', default='.',
+                    help='Directory to write FITS files into')
+    sp.add_argument('-j', '--jobs', type=int, default=4,
+                    help='Number of concurrent downloads')
+    sp.add_argument('--hdu', default=None,
+                    help='Indices of HDUs to include (default: all)')
+    sp.add_argument('--suffix', default='.fits',
+                    help='Appended to md5sum to form the output filename')
+    sp.set_defaults(func=fetch)
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except BrokenPipeError:
+        # Downstream (e.g. "head") closed the pipe. Point stdout at devnull
+        # so the interpreter does not complain again while flushing on exit.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 141  # 128 + SIGPIPE, as a shell would report
+    except KeyboardInterrupt:
+        return 130
+    except Exception as err:
+        sys.stdout.flush()
+        print(f'ERROR: {err}', file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
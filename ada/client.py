@@ -4,7 +4,15 @@ from enum import Enum,auto
 from pprint import pformat as pf
 from pathlib import Path, PosixPath
 from warnings import warn
+from copy import deepcopy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import json
+import os
+import shutil
+import sys
+import threading
+import time
 # Local Packages
 #!import helpers.conf
 # External Packages
@@ -21,8 +29,238 @@ class _Rec(Enum):
     Hdu = auto()
 
 
+class _SingleFlight():
+    """Coalesce concurrent calls that have the same key.
+
+    The first caller for a key (the leader) runs the function. Callers
+    that arrive with the same key while it is running wait for it and
+    get its result, or its exception, instead of making a call of their
+    own.
+    """
+    class _Call():
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.followers = 0  # callers waiting on the leader
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = dict() # calls[key] = _Call
+        self.coalesced = 0  # number of calls that waited on a leader
+
+    def do(self, key, func, copy=None):
+        """Run FUNC unless a call with KEY is already in flight.
+
+        If COPY is given, callers that share the result of the leader
+        each get COPY(result), so that none of them sees changes made
+        by another.
+
+        :returns: Result of (possibly shared) call to FUNC and whether
+                  it was shared with a leader.
+        :rtype: tuple (result, shared)
+
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self._Call()
+            else:
+                call.followers += 1
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return (call.result if copy is None
+                    else copy(call.result)), True
+        try:
+            call.result = func()
+        except BaseException as err:
+            call.error = err
+        with self.lock:
+            del self.calls[key]  # no more followers after this
+        result = call.result
+        if copy is not None and call.followers > 0 and call.error is None:
+            # Followers copy from a copy of their own, since the leader's
+            # caller may change RESULT as soon as it is returned.
+            try:
+                call.result = copy(result)
+            except BaseException as err:
+                call.error = err
+        call.done.set()
+        if call.error is not None:
+            raise call.error
+        return result, False
+
+
+def _link_or_copy(srcfile, outfile):
+    """Make OUTFILE have the content of SRCFILE (overwriting OUTFILE).
+    Hardlink when possible (same filesystem), otherwise copy."""
+    if os.path.abspath(srcfile) == os.path.abspath(outfile):
+        return
+    partfile = f'{outfile}.part'
+    try:
+        os.link(srcfile, partfile)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(srcfile, partfile)
+    os.replace(partfile, outfile)
+
+class _Endpoint():
+    """Latency and error statistics for one Archive front end (base URL).
+
+    Latency and error rate are exponentially weighted moving averages
+    (EWMA) so that recent requests count the most. Recent latencies are
+    also kept per kind of request (OP), since e.g. a count takes much
+    longer than a version check or the headers of a download.
+    """
+    ALPHA = 0.2         # EWMA weight of the newest sample
+    MAX_FAILURES = 3    # consecutive connection failures before "down"
+    RETRY_AFTER = 30.0  # seconds a down endpoint is avoided
+
+    def __init__(self, rooturl):
+        self.rooturl = rooturl.rstrip('/')
+        self.latency = None  # EWMA of seconds to response headers
+        self.errors = 0.0    # EWMA of fraction of requests that failed
+        self.failures = 0    # consecutive failures
+        self.retry_at = 0.0  # time.monotonic() when down endpoint is retried
+        self.samples = dict() # samples[op] = recent latencies (deque)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        lat = 'None' if self.latency is None else f'{self.latency:.3f}'
+        return (f'<_Endpoint {self.rooturl} latency={lat} '
+                f'errors={self.errors:.2f} failures={self.failures}>')
+
+    def record(self, elapsed=None, error=False, op=None):
+        with self.lock:
+            self.errors += self.ALPHA * (float(error) - self.errors)
+            if error:
+                self.failures += 1
+                if self.failures >= self.MAX_FAILURES:
+                    self.retry_at = time.monotonic() + self.RETRY_AFTER
+            else:
+                self.failures = 0
+            if elapsed is not None:
+                self.samples.setdefault(op, deque(maxlen=100)).append(elapsed)
+                if self.latency is None:
+                    self.latency = elapsed
+                else:
+                    self.latency += self.ALPHA * (elapsed - self.latency)
+
+    @property
+    def healthy(self):
+        return ((self.failures < self.MAX_FAILURES)
+                or (time.monotonic() >= self.retry_at))
+
+    @property
+    def score(self):
+        """Expected cost of a request; lower is better. Endpoints that
+        have never answered sort after those that have."""
+        if self.latency is None:
+            return float('inf')
+        return self.latency * (1 + 4 * self.errors)
+
+    def percentile(self, pct, op=None):
+        """Latency (seconds) at percentile PCT of recent samples of OP
+        requests, or None if there are too few samples to say."""
+        with self.lock:
+            samples = sorted(self.samples.get(op, ()))
+        if len(samples) < 10:
+            return None
+        return samples[min(len(samples)-1, int(len(samples) * pct / 100))]
+
+
+class _EndpointPool():
+    """Set of equivalent Archive front ends to choose between."""
+
+    def __init__(self, urls):
+        if isinstance(urls, str):
+            urls = [urls]
+        self.endpoints = [_Endpoint(url) for url in urls]
+        if len(self.endpoints) == 0:
+            raise Exception('At least one Archive URL is required.')
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    @property
+    def primary(self):
+        return self.endpoints[0]
+
+    def ordered(self):
+        """Endpoints to try, best first. Healthy endpoints are sorted by
+        score (ties keep the order given); endpoints that are down are
+        kept as a last resort."""
+        healthy = [ep for ep in self.endpoints if ep.healthy]
+        down = [ep for ep in self.endpoints if not ep.healthy]
+        return sorted(healthy, key=lambda ep: ep.score) + down
+
+    def probe(self, path='api/version/', timeout=10):
+        """Measure latency of every endpoint (concurrently)."""
+        def ping(ep):
+            start = time.monotonic()
+            try:
+                requests.get(f'{ep.rooturl}/{path}', timeout=timeout)
+            except requests.RequestException:
+                ep.record(error=True)
+            else:
+                ep.record(elapsed=time.monotonic() - start, op='probe')
+        with ThreadPoolExecutor(max_workers=len(self.endpoints)) as pool:
+            list(pool.map(ping, self.endpoints))
+        return self.ordered()
+
+
+class _CountCache():
+    """Record counts remembered for up to MAX_AGE seconds.
+
+    If CACHEFILE is given, counts are also saved there (as JSON) so they
+    survive from one process to the next.
+    """
+
+    def __init__(self, max_age=600, cachefile=None):
+        self.max_age = max_age
+        self.cachefile = cachefile
+        self.lock = threading.Lock()
+        self.counts = dict() # counts[key] = (time.time(), count)
+        if cachefile is not None and os.path.exists(cachefile):
+            with open(cachefile) as f:
+                self.counts = {k: tuple(v) for k,v in json.load(f).items()}
+
+    def get(self, key, max_age=None):
+        """Cached count for KEY, or None if missing or older than MAX_AGE."""
+        max_age = self.max_age if max_age is None else max_age
+        with self.lock:
+            stamp, count = self.counts.get(key, (0, None))
+        if time.time() - stamp >= max_age:
+            return None
+        return count
+
+    def put(self, key, count):
+        with self.lock:
+            self.counts[key] = (time.time(), count)
+            if self.cachefile is not None:
+                partfile = f'{self.cachefile}.part'
+                with open(partfile, 'w') as f:
+                    json.dump(self.counts, f)
+                os.replace(partfile, self.cachefile)
+
+    def clear(self):
+        with self.lock:
+            self.counts = dict()
+            if self.cachefile is not None and os.path.exists(self.cachefile):
+                os.remove(self.cachefile)
+
+
 _PROD = 'https://astroarchive.noirlab.edu/'
 
+# Sort that makes paging with OFFSET stable (must be unique per record).
+# An md5sum identifies a File, but is shared by all the HDUs of the File.
+_PAGE_SORT = dict(file='md5sum', hdu='archive_filename,hdu_idx')
+
 class AdaClient():
     """Astro Data Archive Client.
     Instance creation compares the version from the Server
@@ -30,10 +268,46 @@ class AdaClient():
     the Client is a major version or more behind.
     """
     KNOWN_GOOD_API_VERSION = 6.0  #@@@ Change this when Server version increments
+    CHUNK_SIZE = 2**20  # bytes per read when streaming a download
+
+    HEDGE_PERCENTILE = 95  # Latency percentile after which "find" is hedged
+    HEDGE_TIMEOUT = 120    # Seconds a hedged request may wait for data
 
     def __init__(self, url=_PROD,
-                 verbose=False, limit=10, email=None,  password=None):
-        self.rooturl=url.rstrip("/")
+                 verbose=False, limit=10, email=None,  password=None,
+                 coalesce=True, hedge=False, timeout=(5, None),
+                 count_max_age=600, count_cache=None):
+        """Create client for the Archive.
+
+        :param url: Archive server to use, or a list of equivalent
+                    servers (e.g. production and a mirror). Each request
+                    goes to the fastest healthy one; the others are used
+                    when it cannot be reached.
+        :param verbose: Enable verbose output iff True.
+        :param limit: Default maximum number of records returned by "find".
+        :param email: PI email. Only needed for download of proprietary files.
+        :param password: PI password.
+        :param coalesce: Concurrent identical find/retrieve calls share one
+                         request iff True.
+        :param hedge: If a "find" has not answered by the HEDGE_PERCENTILE
+                      latency of its server, send a copy to the next best
+                      server and use whichever answers first.
+        :param timeout: Seconds to wait for a server, as for "requests":
+                        one number, or a tuple (connect, read). The
+                        default only limits connecting, so that an
+                        unreachable server fails over quickly while a
+                        slow search is left to finish.
+        :param count_max_age: Seconds a count from "count", "count_many",
+                              or "file_count" is reused (0 = never).
+        :param count_cache: File to keep counts in between sessions
+                            (default: counts are kept in memory only).
+        """
+        self.endpoints = _EndpointPool(url)
+        self.hedge = hedge
+        self.timeout = timeout
+        self._hedge_pool = None
+        self._hedge_lock = threading.Lock()
+        self.rooturl = self.endpoints.primary.rooturl
         self.apiurl = f'{self.rooturl}/api'
         self.adsurl = f'{self.rooturl}/api/adv_search'
         self.siaurl = f'{self.rooturl}/api/sia'
@@ -43,8 +317,12 @@ class AdaClient():
         self.verbose = verbose
         self.limit = limit
         self.email = email
+        # Concurrent identical find/retrieve calls share one HTTP request
+        self.coalesce = coalesce
+        self._flights = dict(find=_SingleFlight(), retrieve=_SingleFlight())
+        self.counts = _CountCache(max_age=count_max_age, cachefile=count_cache)
         if email is not None:
-            res = requests.post(f'{self.apiurl}/get_token/',
+            res = self._request('POST', f'{self.apiurl}/get_token/',
                                 json=dict(email=email, password=password))
             res.raise_for_status()
             if res.status_code == 200:
@@ -58,7 +336,10 @@ class AdaClient():
                        f'You can still get any metadata.' )
                 raise Exception(msg)
         # Get API Version
-        self.apiversion = float(requests.get(f'{self.apiurl}/version/').content)
+        if len(self.endpoints) > 1:
+            self.endpoints.probe()
+        self.apiversion = float(
+            self._request('GET', f'{self.apiurl}/version/').content)
 
         if (int(self.apiversion) - int(AdaClient.KNOWN_GOOD_API_VERSION)) >= 1:
             msg = (f'The helpers.api module is expecting an older '
@@ -70,9 +351,116 @@ class AdaClient():
             raise Exception(msg)
 
 
+    def _request(self, method, url, hedge=False, op=None, **kwargs):
+        """Send a request to the best endpoint, failing over to the
+        others on connection errors.
+
+        URL is written against the primary endpoint (self.rooturl); its
+        root is replaced by that of the endpoint actually used. OP names
+        the kind of request, whose latencies decide when to hedge.
+        """
+        path = url[len(self.rooturl):].lstrip('/')
+        endpoints = self.endpoints.ordered()
+        err = None
+        for idx,ep in enumerate(endpoints):
+            try:
+                if hedge and idx+1 < len(endpoints):
+                    return self._hedged_send(ep, endpoints[idx+1],
+                                             method, path, op=op, **kwargs)
+                return self._send(ep, method, path, op=op, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if self.verbose:
+                    print(f'Failing over from {ep.rooturl}: {e}')
+                err = e
+        raise err
+
+    def _send(self, ep, method, path, timeout=None, op=None, **kwargs):
+        start = time.monotonic()
+        try:
+            res = requests.request(method, f'{ep.rooturl}/{path}',
+                                   timeout=timeout or self.timeout,
+                                   **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            ep.record(error=True)
+            raise
+        ep.record(elapsed=time.monotonic() - start,
+                  error=(res.status_code >= 500), op=op)
+        return res
+
+    def _hedged_send(self, ep, backup, method, path, op=None, **kwargs):
+        """Send to EP. If it is slower than usual for an OP request, also
+        send to BACKUP and return whichever response arrives first."""
+        delay = ep.percentile(self.HEDGE_PERCENTILE, op=op)
+        if delay is None:
+            return self._send(ep, method, path, op=op, **kwargs)
+        # The request that loses keeps a thread of the pool until it
+        # ends, so it must end even if its server never answers.
+        if isinstance(self.timeout, tuple):
+            connect, read = self.timeout
+        else:
+            connect = read = self.timeout
+        timeout = (connect, read or self.HEDGE_TIMEOUT)
+        pool = self._hedger()
+        first = pool.submit(self._send, ep, method, path, timeout=timeout,
+                            op=op, **kwargs)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        if self.verbose:
+            print(f'Hedging request to {ep.rooturl} with {backup.rooturl}')
+        second = pool.submit(self._send, backup, method, path,
+                             timeout=timeout, op=op, **kwargs)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    return fut.result()
+        return first.result() # Both failed, raise error from EP
+
+    def _hedger(self):
+        """Thread pool for hedged requests (created on first use)."""
+        with self._hedge_lock:
+            if self._hedge_pool is None:
+                self._hedge_pool = ThreadPoolExecutor(
+                    max_workers=8, thread_name_prefix='ada-hedge')
+            return self._hedge_pool
+
+    def close(self):
+        """Release the threads used for hedged requests.
+
+        Requests still in flight are not waited for; they end by
+        themselves within HEDGE_TIMEOUT. The client can still be used
+        (a new pool is made if needed).
+        """
+        with self._hedge_lock:
+            pool, self._hedge_pool = self._hedge_pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def coalesced(self):
+        """Number of calls that were served by another in-flight call.
+
+        :returns: Counts keyed by method name ('find', 'retrieve')
+        :rtype: dict
+
+        """
+        return {k: v.coalesced for k,v in self._flights.items()}
+
     def retrieve(self, fileid, outfile, hdu=None):
         """Download a FITS file.
 
+        If the same FILEID and HDU is already being downloaded by another
+        thread, wait for that download and hardlink (or copy) its file
+        to OUTFILE instead of downloading again.
+
         :param fileid: File ID of FITS file in the Archive.
         :param outfile: Local full path that will be overwritten with FITS file.
         :param hdu: Indices of HDUs to include in file (default: include all)
@@ -80,6 +468,24 @@ class AdaClient():
         :rtype: boolean
 
         """
+        if not self.coalesce:
+            return self._retrieve(fileid, outfile, hdu=hdu)
+
+        def download():
+            self._retrieve(fileid, outfile, hdu=hdu)
+            return outfile
+        srcfile, shared = self._flights['retrieve'].do((fileid, str(hdu)),
+                                                       download)
+        if not shared:
+            return True
+        try:
+            _link_or_copy(srcfile, outfile)
+        except FileNotFoundError:
+            # Leader's file was removed before we got to it.
+            return self._retrieve(fileid, outfile, hdu=hdu)
+        return True
+
+    def _retrieve(self, fileid, outfile, hdu=None):
         # VALIDATE params @@@
 
         ## 401 Unauthorized: File is proprietary and logged in user is
@@ -89,28 +495,89 @@ class AdaClient():
         qparams = '' if hdu is None else f'/?hdu={hdu}'
         url = f'{self.apiurl}/retrieve/{fileid}/{qparams}'
         if self.token is None:
-            res = requests.get(url)
+            res = self._request('GET', url, op='retrieve', stream=True)
         else:
-            res = requests.get(url, headers=dict(Authorization=self.token))
+            res = self._request('GET', url, op='retrieve', stream=True,
+                                headers=dict(Authorization=self.token))
         try:
             res.raise_for_status()
-        except Exception as err:
-            print(f"Could not get token: {res}")
+        except requests.HTTPError as err:
+            res.close()
+            # Not stdout, which may be carrying results (e.g. "ada fetch")
+            print(f'Could not retrieve {fileid}: {res}', file=sys.stderr)
             # Get propid so to help figure out why request failed
-            info,rows = self.find({"outfields": ["proposal"],
-                                     "search":[["md5sum",fileid]]})
+            try:
+                info,rows = self.find({"outfields": ["proposal"],
+                                       "search":[["md5sum",fileid]]})
+            except Exception:
+                rows = []
+            if len(rows) == 0:
+                raise err  # e.g. 404: no such file, so no proposal
             raise Exception(f"{str(err)}"
                             f"; Email={self.email} must be authorized for"
-                            f" Proposal={rows[0]['proposal']}")
+                            f" Proposal={rows[0]['proposal']}") from err
 
-        with open(outfile,'wb') as fits:
-            fits.write(res.content)
+        # Stream to a temporary file next to OUTFILE so memory stays
+        # bounded and a failed download never leaves a truncated OUTFILE.
+        partfile = f'{outfile}.part'
+        try:
+            with open(partfile,'wb') as fits:
+                for chunk in res.iter_content(chunk_size=self.CHUNK_SIZE):
+                    fits.write(chunk)
+            os.replace(partfile, outfile)
+        finally:
+            res.close()
+            if os.path.exists(partfile):
+                os.remove(partfile)
         return True
 
     @property
     def file_count(self):
-        res = self.find({"outfields": ["md5sum"], "search":[]},count=True)
-        return(res[1][0]["count"])
+        return self.count({"outfields": ["md5sum"], "search":[]})
+
+    def count(self, jspec, rectype='file', max_age=None):
+        """Get number of records that match a search specification.
+
+        A count obtained less than MAX_AGE seconds ago is reused.
+
+        :param jspec: The search specification (same as for "find")
+        :param rectype: Type of records to count ('file' or 'hdu')
+        :param max_age: Oldest cached count (in seconds) to accept
+                        (default: count_max_age given to AdaClient)
+        :returns: Number of matching records
+        :rtype: int
+
+        """
+        key = f'{self.rooturl} {rectype} {json.dumps(jspec, sort_keys=True)}'
+        count = self.counts.get(key, max_age=max_age)
+        if count is None:
+            info, rows = self.find(jspec, rectype=rectype, count=True)
+            count = rows[0]['count']
+            self.counts.put(key, count)
+        return count
+
+    def count_many(self, jspecs, rectype='file', max_age=None,
+                   max_workers=8):
+        """Count records matching each of several search specifications.
+
+        Counts that are not cached are requested concurrently.
+
+        :param jspecs: Search specifications. Either a dict of them
+                       (e.g. keyed by instrument) or a list.
+        :param rectype: Type of records to count ('file' or 'hdu')
+        :param max_age: Oldest cached count (in seconds) to accept
+        :param max_workers: Maximum number of concurrent requests
+        :returns: Count for each key of JSPECS (or index, for a list)
+        :rtype: dict
+
+        """
+        if not isinstance(jspecs, dict):
+            jspecs = dict(enumerate(jspecs))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {k: pool.submit(self.count, jspec, rectype=rectype,
+                                      max_age=max_age)
+                       for k,jspec in jspecs.items()}
+            return {k: fut.result() for k,fut in futures.items()}
 
     def find(self,
              jspec={"outfields":["md5sum"],"search":[]},
@@ -122,6 +589,8 @@ class AdaClient():
         :param jspec: The search specification (@@@ more info)
         :param rectype: Type of rows/records to return ('file' or 'hdu')
         :param limit: The maximum number of rows to return
+        :param offset: Number of matching rows to skip (implies a sort)
+        :param sort: Comma separated field names to sort rows by
         :param format: The format of the result ('csv', 'xml', default='json')
         :returns: Header info and Rows
         :rtype: tuple (info,rows)
@@ -145,12 +614,29 @@ class AdaClient():
                       format=format)
         if count:
             uparams['count'] = 'Y'
+        if offset is not None:
+            uparams['offset'] = offset
+        if sort is not None:
+            uparams['sort'] = sort
         qstr = urlencode(uparams)
 
         url = f'{self.adsurl}/find/?{qstr}'
         if verbose:
             print(f'Search using "{url}" with: {json.dumps(jspec)}')
-        res = requests.post(url, json=jspec) # @@@
+        # Counts take far longer than finds, so are timed separately.
+        op = 'count' if count else 'find'
+        if not self.coalesce:
+            return self._find(url, jspec, format, verbose, op)
+
+        key = (url, json.dumps(jspec, sort_keys=True))
+        result, shared = self._flights['find'].do(
+            key, lambda: self._find(url, jspec, format, verbose, op),
+            copy=deepcopy)
+        return result
+
+    def _find(self, url, jspec, format, verbose, op):
+        res = self._request('POST', url, hedge=self.hedge, op=op,
+                            json=jspec) # @@@
         res.raise_for_status()
 
         if res.status_code != 200:
@@ -169,6 +655,40 @@ class AdaClient():
                 #print(f'rows={pf(rows)}')
             return(info, rows)
 
+    def find_pages(self,
+                   jspec={"outfields":["md5sum"],"search":[]},
+                   rectype='file', pagesize=1000, limit=None,
+                   sort=None, verbose=False):
+        """Generate metadata records one page at a time.
+
+        Each page is a separate "find" request using OFFSET, so the
+        first rows are available long before the whole result set has
+        been transferred.
+
+        :param jspec: The search specification (same as for "find")
+        :param rectype: Type of rows/records to return ('file' or 'hdu')
+        :param pagesize: The maximum number of rows per page
+        :param limit: The maximum number of rows over all pages (None=all)
+        :param sort: Sort order used to make paging stable. Must be
+                     unique per record (default depends on RECTYPE).
+        :returns: Header info and Rows of each page
+        :rtype: generator of tuple (info,rows)
+
+        """
+        sort = sort or _PAGE_SORT[rectype]
+        offset = 0
+        while True:
+            lim = pagesize if limit is None else min(pagesize, limit-offset)
+            if lim <= 0:
+                return
+            info, rows = self.find(jspec, rectype=rectype, limit=lim,
+                                   offset=offset, sort=sort, verbose=verbose)
+            if len(rows) > 0:
+                yield info, rows
+            if len(rows) < lim:
+                return
+            offset += len(rows)
+
 #!    @deprecated(reason='Use "find" instead.')
 #!    def search(self, jspec, limit=False, format='json'):
 #!        """Search metadata according to jspec'
@@ -209,7 +729,8 @@ class AdaClient():
 #!            return(info, rows)
 
     def vosearch(self, ra, dec, size,
-                 rectype='file', format='votable', limit=None):
+                 rectype='file', format='votable', limit=None,
+                 parse=False):
         """SIA search by region of interest given by RA, DEC, and size.
 
         :param ra: right-ascension of the field center,
@@ -219,9 +740,15 @@ class AdaClient():
         :param size: The coordinate angular size of the region given
                      in decimal degrees. SINGLE VALUE for now. Example: '0.3'
         :param limit: The maximum number of rows to return
-        :param format: The format of the result ('csv', 'xml', default='json')
-        :returns: Header info and Rows
-        :rtype: tuple (info,rows)
+        :param format: The format of the result ('json', 'csv', 'xml',
+                       default='votable')
+        :param parse: When format='votable', return a DataFrame parsed
+                      from the VOTable (as it downloads) instead of bytes.
+        :returns: If PARSE, one column per FIELD of the VOTable, with its
+                  INFO name/value pairs in "df.attrs['info']". Otherwise
+                  header info and rows for format='json', or the content
+                  of the response (bytes) for other formats.
+        :rtype: pandas.DataFrame, tuple (info,rows), or bytes
 
         """
         voep = 'vohdu' if rectype=='hdu' else 'voimg' # VO EndPoint
@@ -234,15 +761,22 @@ class AdaClient():
         if self.verbose:
             print(f'Search invoking "{url}" with: ra={ra}, dec={dec}, '
                   f'size={size}')
-        res = requests.get(url)
+        parse = parse and (format == 'votable')
+        res = self._request('GET', url, stream=parse)
         res.raise_for_status()
-        if self.verbose:
+        if self.verbose and not parse:
             print(f'Search status={res.status_code} res={res.content}')
 
         if res.status_code != 200:
             raise Exception(f'status={res.status_code} content={res.content}')
 
-        if format == 'json':
+        if parse:
+            # Imported here so that numpy/pandas load only when needed.
+            from ada.votable import parse_votable
+            res.raw.decode_content = True
+            with res:
+                return parse_votable(res.raw)
+        elif format == 'json':
             result = res.json()
             info = result.pop(0)
             rows = result
@@ -258,14 +792,14 @@ class AdaClient():
         :rtype: boolean
 
         """
-        res = requests.get(f"{self.apiurl}​/version​/")
+        res = self._request('GET', f"{self.apiurl}​/version​/")
         res.raise_for_status()
         return(True)
 
     def _get_categoricals(self):
         if self.categoricals is None:
             url = f'{self.adsurl}/cat_lists/'
-            res = requests.get(url)
+            res = self._request('GET', url)
             res.raise_for_status()
             self.categoricals = res.json()  # dict(catname) = [val1, val2, ...]
         return(self.categoricals)
@@ -274,7 +808,7 @@ class AdaClient():
         # @@@ VALIDATE instrument, proctype, type
         t = 'hdu' if self.type == _Rec.Hdu else 'file'
         url = f'{self.adsurl}/aux_{t}_fields/{instrument}/{proctype}/'
-        res = requests.get(url)
+        res = self._request('GET', url)
         res.raise_for_status()
         print(f"url={url}; res={res}; content={res.content}")
         return(res.json())
@@ -282,7 +816,7 @@ class AdaClient():
     def _get_core_fields(self):
         t = 'hdu' if self.type == _Rec.Hdu else 'file'
         # @@@ VALIDATE instrument, proctype, type
-        res = requests.get(f'{self.adsurl}/core_{t}_fields/')
+        res = self._request('GET', f'{self.adsurl}/core_{t}_fields/')
         res.raise_for_status()
         return(res.json())
 
@@ -298,9 +832,7 @@ class AdaClient():
 
         """
         if self.apiversion is None:
-            response = self.requests.get(f'{self.apiurl}/version',
-                                         timeout=self.TIMEOUT,
-                                         cache=True)
+            response = self._request('GET', f'{self.apiurl}/version/')
             self.apiversion = float(response.content)
         return self.apiversion
 
@@ -0,0 +1,321 @@
+"""Download files found in the Archive and process them as they arrive.
+
+Downloads run in a pool of threads and the user supplied function runs
+in a pool of processes, so that neither the network nor the CPUs sit
+idle. Files waiting to be processed are limited in number and total
+size, after which downloading pauses (backpressure). EXAMPLE:
+  def npix(path, row):        # must be importable (picklable)
+      return os.path.getsize(path)
+
+  client = AdaClient()
+  pipe = Pipeline(client, npix, downloads=4, processes=8,
+                  disk_budget=20e9)
+  spec = {"outfields": ["md5sum", "filesize"],
+          "search": [["instrument", "decam"], ["proc_type", "instcal"]]}
+  for row, result in pipe.run_find(spec, limit=100):
+      print(row['md5sum'], result)
+  print(pipe.stats)
+"""
+# Python Standard Library
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+# Local Packages
+# <none>
+# External Packages
+# <none>
+
+
+def _process(func, path, row):
+    """Run FUNC in a worker process and time it."""
+    start = time.monotonic()
+    result = func(path, row)
+    return time.monotonic() - start, result
+
+
+class _Stage():
+    """Busy time of the workers of one pipeline stage."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.count = 0
+        self.busy = 0.0  # seconds, summed over workers
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.busy += seconds
+
+    def report(self, wall):
+        utilization = self.busy / (wall * self.workers) if wall > 0 else 0.0
+        return dict(workers=self.workers, count=self.count,
+                    busy=self.busy, utilization=utilization)
+
+
+class Pipeline():
+    """Retrieve files of rows from "find" and process each with FUNC.
+
+    FUNC is called as FUNC(path, row) in a worker process, where PATH is
+    the local copy of the file of ROW. It must therefore be picklable
+    (e.g. defined at the top level of a module).
+
+    Worker processes are started with "spawn" rather than "fork", since
+    the first one starts while download threads are in the middle of
+    requests, and forking a process with threads can deadlock the child.
+    So a script that runs a Pipeline must guard its top level code with
+    "if __name__ == '__main__':".
+    """
+
+    def __init__(self, client, func, downloads=4, processes=None,
+                 queue_size=None, disk_budget=None, workdir=None,
+                 cleanup=True, ordered=False, errors='raise', hdu=None):
+        """Create a pipeline. Nothing is started until "run".
+
+        :param client: AdaClient used to retrieve files
+        :param func: Function to call as FUNC(path, row) on each file
+        :param downloads: Number of concurrent downloads
+        :param processes: Number of worker processes (default: CPU count)
+        :param queue_size: Maximum number of downloaded files waiting for
+                           a worker process (default: 2 per process)
+        :param disk_budget: Maximum bytes of files downloaded but not yet
+                            processed (default: no limit). Uses the
+                            "filesize" of rows, when given, to decide
+                            before a download starts; otherwise the
+                            mean size of files downloaded so far.
+        :param workdir: Directory to download into (default: a new
+                        temporary directory, removed when done)
+        :param cleanup: Remove each file once it has been processed
+        :param ordered: Deliver results in the order of the rows, instead
+                        of as they complete
+        :param errors: 'raise' to raise a failed download or FUNC call
+                       from "run", or 'yield' to deliver the exception in
+                       place of the result
+        :param hdu: Indices of HDUs to retrieve (default: all)
+        """
+        if errors not in ('raise', 'yield'):
+            raise Exception(f'errors must be "raise" or "yield", '
+                            f'not "{errors}"')
+        self.client = client
+        self.func = func
+        self.downloads = downloads
+        self.processes = processes or os.cpu_count() or 1
+        self.queue_size = queue_size or 2 * self.processes
+        self.disk_budget = disk_budget
+        self.workdir = workdir
+        self.cleanup = cleanup
+        self.ordered = ordered
+        self.errors = errors
+        self.hdu = hdu
+        self._reset()
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._stop = False
+        self._inflight = 0     # rows started but not yet delivered
+        self._staged = 0       # bytes downloaded but not yet processed
+        self._staged_max = 0
+        self._downloaded = 0   # bytes downloaded in total
+        self._blocked = 0.0    # seconds feeding waited for space
+        self._download = _Stage(self.downloads)
+        self._process = _Stage(self.processes)
+        self._start = None
+        self._end = None
+
+    @property
+    def stats(self):
+        """Utilization of each stage of the last (or current) run.
+
+        Download utilization near 1 with low process utilization means
+        the network is the bottleneck; the reverse (with a large
+        "blocked" time) means processing is.
+
+        :returns: Stats of 'download' and 'process' stages, plus 'wall'
+                  seconds, seconds feeding was 'blocked' by backpressure,
+                  and 'staged_max' bytes waiting at once.
+        :rtype: dict
+
+        """
+        if self._start is None:
+            wall = 0.0
+        else:
+            wall = (self._end or time.monotonic()) - self._start
+        return dict(wall=wall,
+                    blocked=self._blocked,
+                    staged_max=self._staged_max,
+                    download=self._download.report(wall),
+                    process=self._process.report(wall))
+
+    def run_find(self, jspec, rectype='file', pagesize=1000, limit=None):
+        """Run pipeline on the rows that match JSPEC (see "run").
+
+        JSPEC must include "md5sum" in its outfields. Including
+        "filesize" lets the disk budget be applied before downloading.
+        """
+        rows = (row
+                for info, page in self.client.find_pages(
+                        jspec, rectype=rectype, pagesize=pagesize,
+                        limit=limit)
+                for row in page)
+        return self.run(rows)
+
+    def run(self, rows):
+        """Retrieve and process the file of each row.
+
+        :param rows: Iterable of dict, each with at least an "md5sum"
+        :returns: Row and the value FUNC returned for it
+        :rtype: generator of tuple (row, result)
+
+        """
+        self._reset()
+        self._start = time.monotonic()
+        tmpdir = None
+        if self.workdir is None:
+            workdir = tmpdir = tempfile.mkdtemp(prefix='ada-pipeline-')
+        else:
+            workdir = self.workdir
+            os.makedirs(workdir, exist_ok=True)
+        results = queue.Queue()  # (idx, row, result, error) or total rows
+        procfutures = set()
+        dlpool = ThreadPoolExecutor(max_workers=self.downloads)
+        procpool = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context('spawn'))
+
+        # Each row must put exactly one item on RESULTS, whatever fails,
+        # or "run" waits for it forever.
+        def processed(idx, row, path, size, fut):
+            error = result = None
+            try:
+                try:
+                    elapsed, result = fut.result()
+                    self._process.add(elapsed)
+                finally:
+                    if self.cleanup and os.path.exists(path):
+                        os.remove(path)
+            except BaseException as err:
+                error = err
+            finally:
+                with self._cond:
+                    procfutures.discard(fut)
+                    self._staged -= size
+                    self._cond.notify_all()
+                results.put((idx, row, result, error))
+
+        def download(idx, row, size):
+            if self._stop:
+                return
+            path = None
+            staged = size  # bytes of this row counted in self._staged
+            try:
+                try:
+                    path = os.path.join(workdir,
+                                        f'{idx}-{row["md5sum"]}.fits')
+                    start = time.monotonic()
+                    self.client.retrieve(row['md5sum'], path, hdu=self.hdu)
+                    self._download.add(time.monotonic() - start)
+                    actual = os.path.getsize(path)
+                    with self._cond:
+                        self._downloaded += actual
+                        self._staged += actual - size
+                        self._staged_max = max(self._staged_max,
+                                               self._staged)
+                        staged = actual
+                    fut = procpool.submit(_process, self.func, path, row)
+                except BaseException:
+                    if path is not None and os.path.exists(path):
+                        os.remove(path)
+                    raise
+            except BaseException as err:
+                with self._cond:
+                    self._staged -= staged
+                    self._cond.notify_all()
+                results.put((idx, row, None, err))
+                return
+            with self._cond:
+                procfutures.add(fut)
+            fut.add_done_callback(
+                lambda f: processed(idx, row, path, actual, f))
+
+        def space_available(size):
+            if self._inflight >= self.queue_size + self.downloads:
+                return False
+            if self.disk_budget is None or self._staged == 0:
+                return True
+            return self._staged + size <= self.disk_budget
+
+        def feed():
+            count = 0
+            try:
+                for idx,row in enumerate(rows):
+                    start = time.monotonic()
+                    with self._cond:
+                        # Unknown sizes are taken to be the mean so far
+                        # (the whole budget until a download finishes).
+                        size = int(row.get('filesize') or 0)
+                        if size == 0 and self._download.count > 0:
+                            size = self._downloaded // self._download.count
+                        elif size == 0:
+                            size = int(self.disk_budget or 0)
+                        while not (self._stop or space_available(size)):
+                            self._cond.wait()
+                        if self._stop:
+                            return
+                        self._inflight += 1
+                        self._staged += size
+                    self._blocked += time.monotonic() - start
+                    dlpool.submit(download, idx, row, size)
+                    count += 1
+            except BaseException as err:
+                results.put((None, None, None, err))
+            finally:
+                results.put(count)
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        waiting = dict() # waiting[idx] = item, if ordered
+        nextidx = 0
+        delivered = 0
+        total = None
+        try:
+            while total is None or delivered < total:
+                item = results.get()
+                if isinstance(item, int):
+                    total = item
+                    continue
+                idx, row, result, error = item
+                if idx is None:  # Could not get rows
+                    raise error
+                if self.ordered:
+                    waiting[idx] = item
+                    ready = list()
+                    while nextidx in waiting:
+                        ready.append(waiting.pop(nextidx))
+                        nextidx += 1
+                else:
+                    ready = [item]
+                for idx, row, result, error in ready:
+                    delivered += 1
+                    with self._cond:
+                        self._inflight -= 1
+                        self._cond.notify_all()
+                    if error is not None and self.errors == 'raise':
+                        raise error
+                    yield row, (result if error is None else error)
+        finally:
+            with self._cond:
+                self._stop = True
+                self._cond.notify_all()
+                pending = list(procfutures)
+            for fut in pending:
+                fut.cancel()
+            dlpool.shutdown(wait=True)
+            procpool.shutdown(wait=True)
+            self._end = time.monotonic()
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
@@ -0,0 +1,649 @@
+"""Parse a VOTable (as returned by the SIA "vosearch") into columns.
+
+Only what is needed to turn a result TABLE into a pandas DataFrame is
+supported: FIELD definitions and TABLEDATA, BINARY or BINARY2 data.
+The XML is read in chunks, and each block of complete rows (of TABLEDATA
+or of the decoded BINARY STREAM) is converted to typed arrays as soon as
+it has been read. So besides the resulting DataFrame, memory holds only
+about one chunk of XML and one block of rows. Blocks of plain TABLEDATA
+rows (one "<TD>value</TD>" per FIELD) are split into cells with one
+simple regular expression pass rather than one expat callback per cell;
+expat reads any other rows.
+EXAMPLE:
+  df = parse_votable(open('sia.xml', 'rb'))
+"""
+# Python Standard Library
+from xml.parsers import expat
+import base64
+import binascii
+import re
+import struct
+# Local Packages
+# <none>
+# External Packages
+import numpy as np
+import pandas as pd
+
+# dtype of each VOTable datatype as found in BINARY serializations (big endian)
+_DTYPES = {
+    'boolean': 'S1',
+    'bit': 'u1',
+    'unsignedByte': 'u1',
+    'short': '>i2',
+    'int': '>i4',
+    'long': '>i8',
+    'char': 'S1',
+    'unicodeChar': 'V2',  # UCS-2. Not "S", which would drop trailing NULs
+    'float': '>f4',
+    'double': '>f8',
+    'floatComplex': '>c8',
+    'doubleComplex': '>c16',
+}
+_INTS = {'bit', 'unsignedByte', 'short', 'int', 'long'}
+_TRUE = {'T', 't', '1', 'true', 'True', 'TRUE'}
+_BOOL_NULLS = {'', '?'}
+
+_BLOCK_ROWS = 10000    # TABLEDATA rows converted to arrays at a time
+_BLOCK_BYTES = 2**20   # bytes of BINARY STREAM decoded at a time
+_BLOCK_CHARS = 2**17   # characters of TABLEDATA split into cells at a time
+
+# For reading TABLEDATA without calling back from expat for every cell.
+_TABLEDATA = re.compile(rb'<(\w+:)?TABLEDATA\s*>')
+_TABLEDATA_END = re.compile(rb'</(\w+:)?TABLEDATA\s*>')
+_SPACE = re.compile(r'\s+')
+_ENCODING = re.compile(rb'<\?xml[^>]*encoding=["\']([^"\']+)')
+_NO_SPACE = str.maketrans('', '', ' \t\r\n')
+
+
+class _Field():
+    """One FIELD of a VOTable TABLE.
+
+    Values are converted a block of rows at a time into "pieces", each
+    a tuple (values, missing) where MISSING is a boolean array or None.
+    "column" joins the pieces of the FIELD into a pandas Series.
+    """
+
+    def __init__(self, attrs):
+        self.name = attrs.get('name') or attrs.get('ID')
+        self.datatype = attrs.get('datatype', 'char')
+        if self.datatype not in _DTYPES:
+            raise Exception(f'Unsupported VOTable datatype "{self.datatype}" '
+                            f'for FIELD "{self.name}"')
+        self.null = None  # set from VALUES element, if any
+        # ARRAYSIZE is like: None (scalar), "8", "8*", "*", "3x4", "3x*"
+        arraysize = attrs.get('arraysize')
+        self.variable = arraysize is not None and arraysize.endswith('*')
+        self.count = 1
+        if arraysize is not None:
+            for dim in arraysize.split('x'):
+                if not dim.endswith('*'):
+                    self.count *= int(dim)
+        self.is_string = self.datatype in ('char', 'unicodeChar')
+        self.is_array = (not self.is_string) and (self.variable
+                                                  or self.count != 1)
+
+    @property
+    def itemsize(self):
+        return np.dtype(_DTYPES[self.datatype]).itemsize
+
+    @property
+    def native(self):
+        """dtype of values in the resulting column."""
+        if self.is_string or self.is_array:
+            return np.dtype(object)
+        if self.datatype == 'boolean':
+            return np.dtype(bool)
+        return np.dtype(_DTYPES[self.datatype]).newbyteorder('=')
+
+    @property
+    def dtype(self):
+        """Structured dtype component for a fixed size FIELD."""
+        if self.datatype == 'bit':
+            return np.dtype(('u1', ((self.count + 7) // 8,)))
+        if self.datatype == 'unicodeChar':
+            return np.dtype(f'V{self.count * self.itemsize}')
+        if self.is_string:
+            return np.dtype(f'S{self.count * self.itemsize}')
+        if self.count == 1:
+            return np.dtype(_DTYPES[self.datatype])
+        return np.dtype((_DTYPES[self.datatype], (self.count,)))
+
+    def from_text(self, values):
+        """Piece from list of TABLEDATA strings."""
+        if self.is_string:
+            return _objects(values), None
+        if self.is_array and self.datatype == 'boolean':
+            return _objects([np.array([b in _TRUE for b in v.split()],
+                                      dtype=bool)
+                             for v in values]), None
+        if self.is_array and self.array_dtype.kind == 'c':
+            return _objects([_complex(v.split(), self.array_dtype)
+                             for v in values]), None
+        if self.is_array:
+            return _objects([np.array(v.split(), dtype=self.array_dtype)
+                             for v in values]), None
+        if self.native.kind == 'c':
+            words = list()
+            for v in values:
+                pair = v.split() or ['nan', 'nan']
+                if len(pair) != 2:
+                    raise ValueError(f'Bad {self.datatype} "{v}" in FIELD '
+                                     f'"{self.name}" (need real and '
+                                     f'imaginary parts)')
+                words.extend(pair)
+            return _complex(words, self.native), None
+        if self.datatype == 'boolean':
+            values = [v.strip() for v in values]
+            missing = np.array([v in _BOOL_NULLS for v in values], dtype=bool)
+            return (np.array([v in _TRUE for v in values], dtype=bool),
+                    missing if missing.any() else None)
+        # Numbers. Empty cells are rare, so only looked for when numpy
+        # cannot convert them all.
+        if self.datatype in _INTS:
+            try:
+                col = np.array(values).astype(self.native)
+                missing = None
+            except ValueError:
+                missing = np.array([v.strip() == '' for v in values],
+                                   dtype=bool)
+                col = np.array(['0' if m else v for v,m in zip(values, missing)]
+                               ).astype(self.native)
+            if self.null is not None:
+                nulls = col == int(self.null)
+                missing = nulls if missing is None else (nulls | missing)
+            return col, (missing if missing is not None and missing.any()
+                         else None)
+        # Floating point
+        try:
+            col = np.array(values).astype(self.native)
+        except ValueError:
+            col = np.array([v if v.strip() != '' else 'nan' for v in values]
+                           ).astype(self.native)
+        if self.null is not None:
+            col[col == float(self.null)] = np.nan
+        return col, None
+
+    @property
+    def array_dtype(self):
+        return np.dtype(_DTYPES[self.datatype]).newbyteorder('=')
+
+    def from_binary(self, col, missing=None):
+        """Piece from values of this FIELD in BINARY data."""
+        if self.is_array and self.datatype == 'boolean':
+            return _objects([np.isin(np.asarray(v, dtype='S1'),
+                                     [b'T', b't', b'1'])
+                             for v in col]), missing
+        if self.datatype == 'boolean':
+            col = np.asarray(col, dtype='S1')
+            nulls = np.isin(col, [b'?', b'', b' '])
+            if missing is not None:
+                nulls |= missing
+            return (np.isin(col, [b'T', b't', b'1']),
+                    nulls if nulls.any() else None)
+        if self.is_string:
+            if self.datatype == 'unicodeChar':
+                strs = [bytes(v).decode('utf-16-be').rstrip('\0')
+                        for v in col]
+            else:
+                strs = [bytes(v).decode('latin-1').rstrip('\0') for v in col]
+            return _objects(strs), missing
+        if self.datatype == 'bit' and not self.is_array:
+            col = np.asarray(col, dtype='u1')
+            if col.ndim == 2:
+                col = col[:, 0]
+            col = (col >> 7) & 1  # first bit is the most significant
+        elif self.datatype == 'bit':
+            col = _objects([np.unpackbits(np.asarray(v, dtype='u1'))
+                            [:len(v) * 8 if self.variable else self.count]
+                            for v in col])
+            return col, missing
+        elif self.is_array:
+            return _objects([np.asarray(v).astype(self.array_dtype)
+                             for v in col]), missing
+        col = np.asarray(col).astype(self.native)
+        if self.datatype in _INTS:
+            nulls = (col == int(self.null)) if self.null is not None else None
+            if missing is not None:
+                nulls = missing if nulls is None else (nulls | missing)
+            return col, (nulls if nulls is not None and nulls.any() else None)
+        if self.null is not None and col.dtype.kind == 'f':
+            nulls = col == float(self.null)
+            missing = nulls if missing is None else (nulls | missing)
+        if missing is not None and missing.any():
+            col[missing] = np.nan
+        return col, None
+
+    def column(self, pieces):
+        """Series from the pieces of all blocks of rows."""
+        if len(pieces) == 0:
+            return pd.Series(np.empty(0, dtype=self.native))
+        values = np.concatenate([v for v,m in pieces])
+        if all(m is None for v,m in pieces):
+            mask = None
+        else:
+            mask = np.concatenate([np.zeros(len(v), dtype=bool) if m is None
+                                   else m for v,m in pieces])
+        if mask is None or not mask.any():
+            return pd.Series(values)
+        if values.dtype == object:
+            values[mask] = None
+            return pd.Series(values)
+        if self.datatype == 'boolean':
+            return pd.Series(pd.arrays.BooleanArray(values, mask))
+        if self.datatype in _INTS:
+            return pd.Series(pd.arrays.IntegerArray(values, mask))
+        values[mask] = np.nan
+        return pd.Series(values)
+
+
+def _complex(words, dtype):
+    """Complex array of DTYPE from WORDS, that are real and imaginary
+    parts in turn (as in TABLEDATA)."""
+    if len(words) % 2 != 0:
+        raise ValueError(f'Odd number of parts in complex values "{words}"')
+    parts = np.array(words, dtype='f8').reshape(-1, 2)
+    return (parts[:, 0] + 1j * parts[:, 1]).astype(dtype)
+
+
+def _objects(values):
+    """1-D object array of VALUES (which may themselves be arrays)."""
+    arr = np.empty(len(values), dtype=object)
+    arr[:] = values
+    return arr
+
+
+def _rowtype(fields, binary2):
+    """Structured dtype of a BINARY row whose FIELDs have a fixed size."""
+    items = [(f'f{i}', f.dtype) for i,f in enumerate(fields)]
+    if binary2:
+        items.insert(0, ('nullflags', 'u1', ((len(fields) + 7) // 8,)))
+    return np.dtype(items)
+
+
+def _decode_fixed(fields, rowtype, data, binary2):
+    """Decode whole rows of BINARY data whose FIELDs have a fixed size.
+
+    :returns: Piece for each FIELD, and number of bytes decoded
+    """
+    nrows = len(data) // rowtype.itemsize
+    table = np.frombuffer(data, dtype=rowtype, count=nrows)
+    if binary2:
+        flags = np.unpackbits(table['nullflags'], axis=1).astype(bool)
+    pieces = list()
+    for i,field in enumerate(fields):
+        missing = flags[:, i] if binary2 else None
+        pieces.append(field.from_binary(table[f'f{i}'], missing))
+    return pieces, nrows * rowtype.itemsize
+
+
+# struct format of scalar VOTable datatypes (for variable length rows)
+_STRUCT = {'boolean': 'c', 'unsignedByte': 'B', 'short': 'h', 'int': 'i',
+           'long': 'q', 'float': 'f', 'double': 'd'}
+
+
+def _row_layout(fields):
+    """Split a row into segments that can each be read with one call.
+
+    :returns: Segments that are either ('struct', struct.Struct, indices)
+              for a run of fixed size FIELDs, or ('field', None, index)
+              for any other FIELD.
+    """
+    layout = list()
+    fmt, run = '>', list()
+    for i,field in enumerate(fields):
+        if (not field.variable) and field.is_string:
+            code = f'{field.count * field.itemsize}s'
+        elif (not field.variable) and (not field.is_array) \
+             and field.datatype in _STRUCT:
+            code = _STRUCT[field.datatype]
+        else:
+            code = None
+        if code is not None:
+            fmt += code
+            run.append(i)
+            continue
+        if run:
+            layout.append(('struct', struct.Struct(fmt), run))
+            fmt, run = '>', list()
+        layout.append(('field', None, i))
+    if run:
+        layout.append(('struct', struct.Struct(fmt), run))
+    return layout
+
+
+class _Short(Exception):
+    """Data ends before the current row does."""
+
+
+def _decode_variable(fields, layout, data, binary2):
+    """Decode whole rows of BINARY data (some FIELDs are variable length).
+
+    :returns: Piece for each FIELD, and number of bytes decoded
+    """
+    nflags = (len(fields) + 7) // 8 if binary2 else 0
+    itemsizes = [f.itemsize for f in fields]
+    values = [list() for f in fields]
+    flags = list()
+    nrows = 0
+    pos = rowstart = 0
+    end = len(data)
+    try:
+        while pos < end:
+            rowstart = pos
+            if pos + nflags > end:
+                raise _Short()
+            if binary2:
+                flags.append(data[pos:pos+nflags])
+                pos += nflags
+            for kind,st,idx in layout:
+                if kind == 'struct':
+                    if pos + st.size > end:
+                        raise _Short()
+                    for i,val in zip(idx, st.unpack_from(data, pos)):
+                        values[i].append(val)
+                    pos += st.size
+                    continue
+                field = fields[idx]
+                if field.variable:
+                    if pos + 4 > end:
+                        raise _Short()
+                    count = struct.unpack_from('>i', data, pos)[0]
+                    pos += 4
+                else:
+                    count = field.count
+                if field.datatype == 'bit':
+                    size = (count + 7) // 8
+                else:
+                    size = count * itemsizes[idx]
+                if pos + size > end:
+                    raise _Short()
+                if field.is_string:
+                    val = data[pos:pos+size]
+                elif field.datatype == 'bit':
+                    val = np.frombuffer(data, 'u1', size, pos)
+                    val = val if field.is_array else val[0]
+                else:
+                    val = np.frombuffer(data, _DTYPES[field.datatype],
+                                        count, pos)
+                    val = val if field.is_array else val[0]
+                pos += size
+                values[idx].append(val)
+            nrows += 1
+    except _Short:
+        # Keep partial row for the next block
+        pos = rowstart
+        for vals in values:
+            del vals[nrows:]
+        del flags[nrows:]
+    if binary2 and nrows > 0:
+        flags = np.frombuffer(b''.join(flags), 'u1').reshape(-1, nflags)
+        flags = np.unpackbits(flags, axis=1).astype(bool)
+    pieces = list()
+    for i,field in enumerate(fields):
+        if field.is_string or field.is_array:
+            col = _objects(values[i])
+        else:
+            col = np.array(values[i], dtype=_DTYPES[field.datatype])
+        missing = flags[:, i] if (binary2 and nrows > 0) else None
+        pieces.append(field.from_binary(col, missing))
+    return pieces, pos
+
+
+class _Parser():
+    """Expat handlers that collect the first TABLE of a VOTable."""
+
+    def __init__(self):
+        self.fields = list()
+        self.info = dict()
+        self.pieces = None    # converted values, one list per FIELD
+        self.done = False     # iff first TABLE has been read
+        self.textcols = None  # TABLEDATA strings not yet converted
+        self.icol = 0         # index of FIELD of current TD
+        self.text = list()    # character data of current TD
+        self.collect = False  # iff character data should go to self.text
+        self.encoding = None  # 'BINARY' or 'BINARY2'
+        self.stream = None    # decoded BINARY STREAM not yet converted
+        self.base64 = ''      # undecoded tail of STREAM (< 4 chars)
+        self.rowtype = None   # of BINARY rows, iff all FIELDs fixed size
+        self.layout = None    # of BINARY rows, iff any FIELD variable size
+
+    @property
+    def columns(self):
+        """Columns of the TABLE, or None if it has not been read."""
+        if not self.done:
+            return None
+        columns = dict()
+        for field,pieces in zip(self.fields, self.pieces):
+            columns[field.name] = field.column(pieces)
+            pieces.clear()  # so only one FIELD is ever held twice
+        return columns
+
+    def flush_text(self):
+        """Convert the TABLEDATA strings read so far."""
+        if self.textcols and len(self.textcols[0]) > 0:
+            for f,col,pieces in zip(self.fields, self.textcols, self.pieces):
+                pieces.append(f.from_text(col))
+            self.textcols = [list() for f in self.fields]
+
+    def flush_stream(self, final=False):
+        """Convert the whole rows of BINARY STREAM decoded so far."""
+        if len(self.stream) < (1 if final else _BLOCK_BYTES):
+            return
+        binary2 = self.encoding == 'BINARY2'
+        data = self.stream  # pieces never keep views of it
+        if self.layout is None:
+            pieces, used = _decode_fixed(self.fields, self.rowtype, data,
+                                         binary2)
+        else:
+            pieces, used = _decode_variable(self.fields, self.layout, data,
+                                            binary2)
+        for piece,fieldpieces in zip(pieces, self.pieces):
+            fieldpieces.append(piece)
+        # New buffer, since deleting from the front does not free memory
+        self.stream = bytearray(data[used:])
+
+    def start(self, name, attrs):
+        if self.done:
+            return  # Only the first TABLE is used
+        tag = name.rsplit(':', 1)[-1]  # without namespace prefix
+        if tag == 'TD':
+            self.text = list()
+            self.collect = True
+        elif tag == 'TR':
+            self.icol = 0
+        elif tag == 'FIELD':
+            self.fields.append(_Field(attrs))
+        elif tag == 'VALUES' and len(self.fields) > 0:
+            self.fields[-1].null = attrs.get('null')
+        elif tag == 'INFO':
+            self.info[attrs.get('name')] = attrs.get('value')
+        elif tag == 'DATA':
+            self.pieces = [list() for f in self.fields]
+        elif tag == 'TABLEDATA':
+            self.textcols = [list() for f in self.fields]
+        elif tag in ('BINARY', 'BINARY2'):
+            self.encoding = tag
+        elif tag == 'STREAM':
+            if attrs.get('encoding', 'base64') != 'base64':
+                raise Exception(f'Unsupported VOTable STREAM encoding '
+                                f'"{attrs.get("encoding")}"')
+            if any(f.variable for f in self.fields):
+                self.layout = _row_layout(self.fields)
+            else:
+                self.rowtype = _rowtype(self.fields,
+                                        self.encoding == 'BINARY2')
+            self.stream = bytearray()
+            self.collect = True
+
+    def end(self, name):
+        if self.done:
+            return
+        tag = name.rsplit(':', 1)[-1]
+        if tag == 'TD':
+            if self.icol < len(self.textcols):
+                self.textcols[self.icol].append(''.join(self.text))
+            self.icol += 1
+            self.collect = False
+        elif tag == 'TR':
+            for col in self.textcols[self.icol:]:
+                col.append('')  # row had too few TD
+            if len(self.textcols[0]) >= _BLOCK_ROWS:
+                self.flush_text()
+        elif tag == 'TABLEDATA':
+            self.flush_text()
+            self.textcols = None
+        elif tag == 'STREAM':
+            self.collect = False
+            self.stream += base64.b64decode(self.base64)
+            self.flush_stream(final=True)
+            self.stream = None
+        elif tag == 'TABLE':
+            if self.pieces is None:
+                self.pieces = [list() for f in self.fields]
+            self.done = True
+
+    def chardata(self, data):
+        if not self.collect:
+            return
+        if self.stream is None:
+            self.text.append(data)
+            return
+        # Decode base64 in whole quanta (4 chars) as it arrives.
+        chars = self.base64 + data.translate(_NO_SPACE)
+        usable = len(chars) - len(chars) % 4
+        self.stream += binascii.a2b_base64(chars[:usable])
+        self.base64 = chars[usable:]
+        self.flush_stream()
+
+
+def _chunks(source, chunksize):
+    if isinstance(source, bytes):
+        yield source
+    elif isinstance(source, str):
+        with open(source, 'rb') as f:
+            yield from _chunks(f, chunksize)
+    else:
+        while True:
+            chunk = source.read(chunksize)
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+
+def _td_pattern(prefix):
+    """Regular expression for a plain TD (group 1 is its content)."""
+    return re.compile(f'<{prefix}TD>([^<]*)</{prefix}TD>')
+
+
+def _split_rows(handler, text, td, tr, tr_close):
+    """Convert the cells of the complete TRs in TEXT, a block at a time.
+
+    Only plain rows are split here: one TD per FIELD, with no attributes,
+    entities, CDATA or comments, and nothing but whitespace between the
+    tags. TD is the regular expression of a cell (see _td_pattern), TR
+    and TR_CLOSE the tags of a row.
+
+    :returns: Number of characters of TEXT converted. The rest needs a
+              real XML parser.
+    """
+    ncols = len(handler.fields)
+    if ncols == 0:
+        return 0
+    row = tr + '\0' * ncols + tr_close  # (NUL is never in XML)
+    start = 0
+    while start < len(text):
+        stop = text.rfind(tr_close, start, start + _BLOCK_CHARS)
+        if stop < 0:
+            stop = text.find(tr_close, start)  # a very long row
+        if stop < 0:
+            break  # no complete row left, only what follows the last one
+        stop += len(tr_close)
+        block = text[start:stop]
+        if '&' in block or '<!' in block:
+            break
+        cells = td.findall(block)
+        # Once each cell is a NUL, what is left must be whole rows.
+        skeleton = _SPACE.sub('', td.sub('\0', block))
+        if skeleton != row * (len(cells) // ncols):
+            break
+        for icol,col in enumerate(handler.textcols):
+            col.extend(cells[icol::ncols])
+        handler.flush_text()
+        start = stop
+    return start
+
+
+def parse_votable(source, chunksize=2**20):
+    """Parse the first TABLE of a VOTable into a DataFrame.
+
+    :param source: Filename, bytes, or (binary) file object containing
+                   the VOTable.
+    :param chunksize: Number of bytes to read from SOURCE at a time.
+    :returns: One column per FIELD. INFO name/value pairs of the RESOURCE
+              are in the "attrs['info']" of the result.
+    :rtype: pandas.DataFrame
+
+    """
+    handler = _Parser()
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = chunksize
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.CharacterDataHandler = handler.chardata
+
+    # Everything except the inside of TABLEDATA goes straight to expat.
+    # Inside it, complete rows are split by _split_rows() when possible.
+    pending = b''
+    state = 'head' # 'head', 'tabledata', 'tail'
+    fast = True    # iff document encoding allows _split_rows()
+    tr_close = None
+    for chunk in _chunks(source, chunksize):
+        pending += chunk
+        if state == 'head':
+            match = _ENCODING.search(pending[:200])
+            if match and match.group(1).lower() not in (b'utf-8', b'ascii'):
+                fast = False
+            match = _TABLEDATA.search(pending)
+            if match is None:
+                # Keep enough to see a TABLEDATA tag split across chunks
+                parser.Parse(pending[:-64], False)
+                pending = pending[-64:]
+                continue
+            parser.Parse(pending[:match.end()], False)
+            pending = pending[match.end():]
+            if handler.done:
+                break  # TABLEDATA of a later TABLE
+            prefix = (match.group(1) or b'').decode()
+            td = _td_pattern(prefix)
+            tr_close = f'</{prefix}TR>'.encode()
+            state = 'tabledata' if fast else 'tail'
+        if state == 'tabledata':
+            match = _TABLEDATA_END.search(pending)
+            cut = match.start() if match else pending.rfind(tr_close)
+            if cut < 0:
+                continue
+            if not match:
+                cut += len(tr_close)
+            block, pending = pending[:cut], pending[cut:]
+            text = block.decode('utf-8')
+            used = _split_rows(handler, text, td, f'<{prefix}TR>',
+                               tr_close.decode())
+            if used < len(text):
+                parser.Parse(text[used:].encode('utf-8'), False)
+            if match is None:
+                continue
+            state = 'tail'
+        parser.Parse(pending, False)
+        pending = b''
+        if handler.done:
+            break # Only the first TABLE is used
+    else:
+        parser.Parse(pending, True)
+
+    columns = handler.columns
+    if columns is None:
+        columns = {f.name: f.column([]) for f in handler.fields}
+    df = pd.DataFrame(columns, copy=False)  # not consolidated into a copy
+    df.attrs['info'] = handler.info
+    return df
@@ -31,5 +31,8 @@ setuptools.setup(
     #! package_dir={"": "src"},
     packages=setuptools.find_packages(),
     install_requires=install_require,
+    entry_points={
+        "console_scripts": ["ada=ada.cli:main"],
+    },
     python_requires=">=3.6",
 )
@@ -12,11 +12,27 @@ from unittest import skip,mock,skipIf,skipUnless
 import warnings
 from pprint import pformat,pprint
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from base64 import b64encode
+from io import BytesIO, StringIO
+from math import isnan
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 # Local Packages
-from client.api import AdaClient
+from ada.client import AdaClient, _CountCache
+from ada.votable import parse_votable, _Field, _rowtype, _decode_fixed
+from ada.pipeline import Pipeline
+from ada import cli
 from tests.utils import tic,toc
 # External Packages
-# <none>
+import requests
 
 ### vosia
 
@@ -25,6 +41,61 @@ from tests.utils import tic,toc
 rooturl = 'http://localhost:8020/' #@@@
 
 
+def filesize(path, row):
+    """Processing function for Pipeline tests (runs in worker process)"""
+    time.sleep(row.get('delay', 0))
+    if row.get('bad'):
+        raise ValueError(f'Bad row {row["md5sum"]}')
+    return Path(path).stat().st_size
+
+
+class StubClient():
+    """Stands in for AdaClient in Pipeline tests. "retrieve" writes a
+    file of the row's "filesize" (zero bytes), or fails for md5sums in
+    MISSING. AHEAD is the most files ever retrieved but not delivered."""
+
+    def __init__(self, missing=()):
+        self.missing = set(missing)
+        self.lock = threading.Lock()
+        self.retrieved = 0
+        self.delivered = 0  # counted by the test, as rows come out
+        self.ahead = 0
+
+    def retrieve(self, fileid, outfile, hdu=None):
+        with self.lock:
+            self.retrieved += 1
+            self.ahead = max(self.ahead, self.retrieved - self.delivered)
+        if fileid in self.missing:
+            raise Exception(f'404 Not Found: {fileid}')
+        size = int(fileid.split('-')[1])
+        Path(outfile).write_bytes(bytes(size))
+        return True
+
+
+def response(content=b'', status_code=200):
+    """requests.Response with CONTENT, as if read from a Server"""
+    res = requests.Response()
+    res.status_code = status_code
+    res._content = content
+    res._content_consumed = True
+    return res
+
+
+def offline_client(url='http://archive.test/', **kwargs):
+    """AdaClient that was told API version 6.0 by a fake Server"""
+    with mock.patch('requests.request', return_value=response(b'6.0')), \
+         mock.patch('requests.get', return_value=response(b'6.0')):
+        return AdaClient(url, **kwargs)
+
+
+def wait_until(predicate, timeout=5):
+    """Wait for PREDICATE() to become true (fail test if it does not)"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'Timed out'
+        time.sleep(0.001)
+
+
 class ApiTest(unittest.TestCase):
     """Test access to each endpoint of the Server API"""
 
@@ -52,6 +123,14 @@ class ApiTest(unittest.TestCase):
         """Make sure we are using PROD server"""
         assert rooturl == 'https://astroarchive.noao.edu/'
 
+    def test_failover_1(self):
+        """Unreachable first server fails over to the good one"""
+        client = AdaClient(['http://localhost:1/', rooturl], limit=5)
+        info, rows = client.find({"outfields": ["md5sum"], "search":[]})
+        assert len(rows) == 5
+        best = client.endpoints.ordered()[0]
+        assert best.rooturl == rooturl.rstrip('/')
+
     def test_version(self):
         """Get version of the NOIRLab Astro Data Archive server API"""
         version = self.client.version
@@ -85,6 +164,19 @@ class ApiTest(unittest.TestCase):
         self.count[name] = rows[0].get('count')
         assert len(rows) == 1
 
+    def test_count_many_1(self):
+        """Count files per instrument, then again from the cache"""
+        name = 'count_many_1'
+        jspecs = {inst: {"outfields": ["md5sum"],
+                         "search": [["instrument", inst]]}
+                  for inst in ['decam', 'mosaic3', '90prime']}
+        tic()
+        counts = self.client.count_many(jspecs)
+        self.timing[name] = toc()
+        self.count[name] = counts
+        assert self.client.count_many(jspecs) == counts
+        assert set(counts) == set(jspecs)
+
 #!    def test_find_1(self):
 #!        """Generalized file/hdu search"""
 #!        name = 'find_1'
@@ -157,6 +249,14 @@ class ApiTest(unittest.TestCase):
         else:
             assert False, "Did not get expected exception"
 
+    def test_find_pages_1(self):
+        """2 small pages same as one big one."""
+        spec = {"outfields": ["md5sum", "archive_filename"], "search":[]}
+        pages = list(self.client.find_pages(spec, pagesize=5, limit=10))
+        info, rows = self.client.find(spec, limit=10, sort='md5sum')
+        assert len(pages) == 2
+        assert pages[0][1] + pages[1][1] == rows
+
 #!    # @tag('ads','find')
 #!    def test_find_d0(self):
 #!        """Find using default search spec."""
@@ -318,6 +418,25 @@ class ApiTest(unittest.TestCase):
         ok = self.client.retrieve(fid,'foo.fits')
         assert ok
 
+    ########################################
+    ### pipeline
+    ###
+    def test_pipeline_1(self):
+        """Retrieve and process files, in order, then clean up"""
+        name = 'pipeline_1'
+        spec = {"outfields": ["md5sum", "filesize"],
+                "search": [["instrument", "decam"]]}
+        pipe = Pipeline(self.client, filesize, downloads=2, processes=2,
+                        ordered=True)
+        tic()
+        out = list(pipe.run_find(spec, limit=4))
+        self.timing[name] = toc()
+        self.count[name] = pipe.stats['process']['utilization']
+        info, rows = self.client.find(spec, limit=4, sort='md5sum')
+        assert [row for row,size in out] == rows
+        assert all(size > 0 for row,size in out)
+        assert pipe.stats['download']['count'] == 4
+
     ########################################
     ### vosearch
     ###
@@ -332,6 +451,770 @@ class ApiTest(unittest.TestCase):
         self.timing[name] = toc()
         assert len(votable) == 5, f'Got {len(votable)}'
 
+    def test_vosearch_2(self):
+        """SIA search parsed into columns"""
+        name = "vosearch_2"
+        tic()
+        df = self.client.vosearch(ra=194.5, dec=-18.0, size=3.0,
+                                  rectype='hdu', parse=True)
+        self.timing[name] = toc()
+        self.count[name] = len(df)
+        assert len(df.columns) > 0
+
+
+class VotableTest(unittest.TestCase):
+    """Parse VOTables without using a Server"""
+
+    head = ('<?xml version="1.0"?>'
+            '<VOTABLE xmlns="http://www.ivoa.net/xml/VOTable/v1.3">'
+            '<RESOURCE><INFO name="QUERY_STATUS" value="OK"/><TABLE>'
+            '<FIELD name="md5sum" datatype="char" arraysize="*"/>'
+            '<FIELD name="ra" datatype="double"/>'
+            '<FIELD name="n" datatype="int"><VALUES null="-1"/></FIELD>'
+            '<DATA>')
+    tail = '</DATA></TABLE></RESOURCE></VOTABLE>'
+
+    def test_tabledata(self):
+        tabledata = ('<TABLEDATA>'
+                     '<TR><TD>a&amp;b</TD><TD>1.5</TD><TD>-1</TD></TR>'
+                     '<TR><TD>c</TD><TD></TD><TD>7</TD></TR>'
+                     '</TABLEDATA>')
+        for chunksize in (16, 2**20):
+            df = parse_votable((self.head + tabledata + self.tail).encode(),
+                               chunksize=chunksize)
+            assert df['md5sum'].tolist() == ['a&b', 'c']
+            assert df['ra'][0] == 1.5 and isnan(df['ra'][1])
+            assert df['n'].isna().tolist() == [True, False]
+            assert df.attrs['info'] == {'QUERY_STATUS': 'OK'}
+
+    def test_binary2(self):
+        rows = b''
+        for flags,md5sum,ra,n in [(0, b'ab', 1.5, -1), (0x40, b'c', 0, 7)]:
+            rows += (bytes([flags]) + struct.pack('>i', len(md5sum))
+                     + md5sum + struct.pack('>di', ra, n))
+        binary2 = ('<BINARY2><STREAM encoding="base64">'
+                   f'{b64encode(rows).decode()}</STREAM></BINARY2>')
+        df = parse_votable(BytesIO((self.head + binary2 + self.tail).encode()))
+        assert df['md5sum'].tolist() == ['ab', 'c']
+        assert df['ra'][0] == 1.5 and isnan(df['ra'][1])
+        assert df['n'].isna().tolist() == [True, False]
+
+    def test_tabledata_pretty(self):
+        """Whitespace between and after rows, as in pretty-printed XML"""
+        tabledata = ('<TABLEDATA>\n'
+                     '  <TR><TD>a</TD><TD>1.5</TD><TD>3</TD></TR>\n'
+                     '  <TR>\n    <TD>b</TD>\n    <TD>2.5</TD>\n'
+                     '    <TD>4</TD>\n  </TR>\n'
+                     '</TABLEDATA>\n')
+        for chunksize in (16, 2**20):
+            df = parse_votable((self.head + tabledata + self.tail).encode(),
+                               chunksize=chunksize)
+            assert df['md5sum'].tolist() == ['a', 'b']
+            assert df['ra'].tolist() == [1.5, 2.5]
+            assert df['n'].tolist() == [3, 4]
+        minimal = (b'<?xml version="1.0"?><VOTABLE><RESOURCE><TABLE>'
+                   b'<FIELD name="x" datatype="int"/><DATA><TABLEDATA>'
+                   b'<TR><TD>1</TD></TR>\n</TABLEDATA></DATA></TABLE>'
+                   b'</RESOURCE></VOTABLE>')
+        assert parse_votable(minimal)['x'].tolist() == [1]
+
+    arrays = ('<?xml version="1.0"?><VOTABLE><RESOURCE><TABLE>'
+              '<FIELD name="flags" datatype="boolean" arraysize="3"/>'
+              '<FIELD name="more" datatype="boolean" arraysize="*"/>'
+              '<FIELD name="mag" datatype="float"><VALUES null="-999"/>'
+              '</FIELD>'
+              '<FIELD name="exptime" datatype="double">'
+              '<VALUES null="-999"/></FIELD>'
+              '<DATA>')
+
+    def check_arrays(self, df):
+        assert [v.tolist() for v in df['flags']] == [[True, False, True],
+                                                     [False, False, True]]
+        assert [v.tolist() for v in df['more']] == [[True], []]
+        assert all(v.dtype == bool for v in df['flags'])
+        assert df['mag'][0] == 1.5 and isnan(df['mag'][1])
+        assert isnan(df['exptime'][0]) and df['exptime'][1] == 30.0
+
+    def test_tabledata_arrays(self):
+        """Boolean arrays and VALUES null of floating point FIELDs"""
+        tabledata = ('<TABLEDATA>'
+                     '<TR><TD>T F T</TD><TD>T</TD><TD>1.5</TD>'
+                     '<TD>-999</TD></TR>'
+                     '<TR><TD>F F 1</TD><TD></TD><TD>-999</TD>'
+                     '<TD>30</TD></TR>'
+                     '</TABLEDATA>')
+        self.check_arrays(parse_votable(
+            (self.arrays + tabledata + self.tail).encode()))
+
+    def test_binary_arrays(self):
+        """Boolean arrays and VALUES null of floating point FIELDs"""
+        rows = (b'TFT' + struct.pack('>i', 1) + b'T'
+                + struct.pack('>fd', 1.5, -999)
+                + b'FF1' + struct.pack('>i', 0)
+                + struct.pack('>fd', -999, 30))
+        binary = ('<BINARY><STREAM encoding="base64">'
+                  f'{b64encode(rows).decode()}</STREAM></BINARY>')
+        self.check_arrays(parse_votable(
+            (self.arrays + binary + self.tail).encode()))
+        # Fixed size FIELDs only
+        fixed = self.arrays.replace(
+            '<FIELD name="more" datatype="boolean" arraysize="*"/>', '')
+        rows = (b'TFT' + struct.pack('>fd', 1.5, -999)
+                + b'FF1' + struct.pack('>fd', -999, 30))
+        binary = ('<BINARY><STREAM encoding="base64">'
+                  f'{b64encode(rows).decode()}</STREAM></BINARY>')
+        df = parse_votable((fixed + binary + self.tail).encode())
+        assert [v.tolist() for v in df['flags']] == [[True, False, True],
+                                                     [False, False, True]]
+        assert isnan(df['mag'][1]) and isnan(df['exptime'][0])
+
+    def test_tabledata_unusual(self):
+        """Rows that are not plain are read by expat, in order"""
+        rows = ['<TR><TD>a</TD><TD>1</TD><TD>1</TD></TR>',
+                '<TR><TD>b</TD><TD/><TD>2</TD></TR>',           # empty TD
+                '<TR><TD ref="x">c</TD><TD>3</TD><TD>3</TD></TR>',
+                '<TR><TD>d</TD><TD>4</TD></TR>',                # too few TD
+                '<TR><TD>e</TD><TD>5</TD><TD>5</TD></TR>']
+        tabledata = '<TABLEDATA>' + ''.join(rows) + '</TABLEDATA>'
+        for prefix in ('', 'v:'):
+            votable = (self.head + tabledata + self.tail)
+            if prefix:
+                votable = (votable.replace('<', '<v:').replace('<v:/', '</v:')
+                           .replace('<v:?', '<?')
+                           .replace('xmlns=', 'xmlns:v='))
+            for blockchars in (30, 2**17):
+                with mock.patch('ada.votable._BLOCK_CHARS', blockchars):
+                    df = parse_votable(votable.encode())
+                assert df['md5sum'].tolist() == ['a', 'b', 'c', 'd', 'e']
+                assert df['ra'].isna().tolist() == [False, True,
+                                                    False, False, False]
+                assert df['n'].isna().tolist() == [False, False,
+                                                   False, True, False]
+                assert df['n'][4] == 5
+
+    def test_complex(self):
+        """Complex values are pairs of real and imaginary parts"""
+        head = ('<?xml version="1.0"?><VOTABLE><RESOURCE><TABLE>'
+                '<FIELD name="z" datatype="doubleComplex"/>'
+                '<FIELD name="w" datatype="floatComplex" arraysize="*"/>'
+                '<DATA>')
+        tabledata = ('<TABLEDATA>'
+                     '<TR><TD>1.0 2.0</TD><TD>1 -1 0.5 0</TD></TR>'
+                     '<TR><TD></TD><TD></TD></TR>'
+                     '</TABLEDATA>')
+        df = parse_votable((head + tabledata + self.tail).encode())
+        assert df['z'][0] == 1 + 2j and isnan(df['z'][1].real)
+        assert df['w'][0].tolist() == [1 - 1j, 0.5 + 0j]
+        assert len(df['w'][1]) == 0
+        rows = (struct.pack('>2d', 1.0, 2.0) + struct.pack('>i', 2)
+                + struct.pack('>4f', 1, -1, 0.5, 0)
+                + struct.pack('>2d', 3.0, 0.0) + struct.pack('>i', 0))
+        binary = ('<BINARY><STREAM encoding="base64">'
+                  f'{b64encode(rows).decode()}</STREAM></BINARY>')
+        df = parse_votable((head + binary + self.tail).encode())
+        assert df['z'].tolist() == [1 + 2j, 3 + 0j]
+        assert df['w'][0].tolist() == [1 - 1j, 0.5 + 0j]
+        bad = tabledata.replace('1.0 2.0', '1.0')
+        with self.assertRaisesRegex(ValueError, 'imaginary'):
+            parse_votable((head + bad + self.tail).encode())
+
+    def test_two_tables(self):
+        """Only the first TABLE is used, whatever follows it"""
+        tabledata = ('<TABLEDATA>'
+                     '<TR><TD>a</TD><TD>1.5</TD><TD>3</TD></TR>'
+                     '</TABLEDATA>')
+        second = ('<TABLE><FIELD name="other" datatype="int"/><DATA>'
+                  '<TABLEDATA><TR><TD>9</TD></TR><TR><TD>8</TD></TR>'
+                  '</TABLEDATA></DATA></TABLE>')
+        rows = b'\0' + struct.pack('>i', 1) + b'a' + struct.pack('>di', 1.5, 3)
+        binary2 = ('<BINARY2><STREAM encoding="base64">'
+                   f'{b64encode(rows).decode()}</STREAM></BINARY2>')
+        for data in (tabledata, binary2):
+            votable = (self.head + data + '</DATA></TABLE>' + second
+                       + '</RESOURCE></VOTABLE>').encode()
+            for chunksize in (16, 2**20):
+                df = parse_votable(votable, chunksize=chunksize)
+                assert list(df.columns) == ['md5sum', 'ra', 'n']
+                assert df['md5sum'].tolist() == ['a']
+                assert df['n'].tolist() == [3]
+
+    def binary2_rows(self, nrows):
+        """BINARY2 data for the FIELDs of "head" (every 3rd row null)"""
+        rows = b''
+        for i in range(nrows):
+            md5sum = f'f{i}'.encode()
+            flags = 0x20 if i % 3 == 0 else 0
+            rows += (bytes([flags]) + struct.pack('>i', len(md5sum))
+                     + md5sum + struct.pack('>di', i / 2, i))
+        return ('<BINARY2><STREAM encoding="base64">'
+                f'{b64encode(rows).decode()}</STREAM></BINARY2>')
+
+    def test_binary2_blocks(self):
+        """Rows that cross the end of a block of STREAM are kept whole"""
+        votable = (self.head + self.binary2_rows(50) + self.tail).encode()
+        expected = parse_votable(votable)
+        for blockbytes in (1, 7, 64):
+            with mock.patch('ada.votable._BLOCK_BYTES', blockbytes):
+                df = parse_votable(BytesIO(votable), chunksize=16)
+            assert df['md5sum'].tolist() == [f'f{i}' for i in range(50)]
+            assert df['ra'].tolist() == [i / 2 for i in range(50)]
+            assert df['n'].isna().tolist() == [i % 3 == 0 for i in range(50)]
+            assert df.equals(expected)
+
+    def test_binary_fixed(self):
+        """Fixed size FIELDs are decoded a block at a time"""
+        head = ('<?xml version="1.0"?><VOTABLE><RESOURCE><TABLE>'
+                '<FIELD name="id" datatype="char" arraysize="4"/>'
+                '<FIELD name="flag" datatype="boolean"/>'
+                '<FIELD name="n" datatype="short"><VALUES null="-1"/></FIELD>'
+                '<DATA>')
+        rows = b''.join(struct.pack('>4sch', f'r{i}'.encode(),
+                                    b'TF?'[i % 3:i % 3 + 1],
+                                    -1 if i == 5 else i)
+                        for i in range(40))
+        binary = ('<BINARY><STREAM encoding="base64">'
+                  f'{b64encode(rows).decode()}</STREAM></BINARY>')
+        votable = (head + binary + self.tail).encode()
+        with mock.patch('ada.votable._BLOCK_BYTES', 10):
+            df = parse_votable(votable, chunksize=32)
+        assert df['id'].tolist() == [f'r{i}' for i in range(40)]
+        assert df['flag'].isna().sum() == 13
+        assert df['flag'][0] == True and df['flag'][1] == False
+        assert df['n'].isna().tolist() == [i == 5 for i in range(40)]
+        assert df['n'][39] == 39
+
+    def test_decode_fixed(self):
+        """Only whole rows are decoded; their size in bytes is returned"""
+        fields = [_Field(dict(name='x', datatype='int')),
+                  _Field(dict(name='y', datatype='double', arraysize='2'))]
+        rowtype = _rowtype(fields, binary2=True)
+        assert rowtype.itemsize == 1 + 4 + 16
+        data = (bytes([0x80]) + struct.pack('>i2d', 7, 1.0, 2.0)
+                + bytes([0x40]) + struct.pack('>i2d', 8, 3.0, 4.0)
+                + bytes([0]) + struct.pack('>i', 9))  # partial row
+        pieces, used = _decode_fixed(fields, rowtype, data, binary2=True)
+        assert used == 2 * rowtype.itemsize
+        (xs, xmissing), (ys, ymissing) = pieces
+        assert xs.tolist() == [7, 8] and xmissing.tolist() == [True, False]
+        assert ys[0].tolist() == [1.0, 2.0]
+        assert ymissing.tolist() == [False, True]
+
+    def test_tabledata_fallback(self):
+        """Blocks that need expat (entities) keep their rows in order"""
+        tds = ['<TR><TD>{}</TD><TD>{}</TD><TD>{}</TD></TR>'.format(
+            'a&lt;b' if i == 7 else f'r{i}', i / 4, i) for i in range(20)]
+        tabledata = '<TABLEDATA>' + ''.join(tds) + '</TABLEDATA>'
+        votable = (self.head + tabledata + self.tail).encode()
+        for blockchars in (50, 200, 2**17):
+            with mock.patch('ada.votable._BLOCK_CHARS', blockchars):
+                df = parse_votable(votable, chunksize=64)
+            assert df['md5sum'].tolist() == [
+                'a<b' if i == 7 else f'r{i}' for i in range(20)]
+            assert df['ra'].tolist() == [i / 4 for i in range(20)]
+            assert df['n'].tolist() == list(range(20))
+
+class CoalesceTest(unittest.TestCase):
+    """Concurrent identical requests share one request (no Server)"""
+
+    nthreads = 8
+
+    def setUp(self):
+        self.client = offline_client()
+        self.release = threading.Event()
+        self.urls = list()
+
+    def request(self, content):
+        """Fake "requests.request" that blocks until RELEASE is set"""
+        def request(method, url, **kwargs):
+            self.urls.append(url)
+            assert self.release.wait(5)
+            if isinstance(content, Exception):
+                raise content
+            return response(content)
+        return request
+
+    def run_all(self, name, func, content, args):
+        """Call FUNC(ARG) for each of ARGS, in a thread each, all while
+        one request is in flight. NAME is the key of FUNC in
+        "coalesced". Return the futures."""
+        before = self.client.coalesced[name]
+        with mock.patch('requests.request',
+                        side_effect=self.request(content)):
+            with ThreadPoolExecutor(max_workers=self.nthreads) as pool:
+                futures = [pool.submit(func, arg) for arg in args]
+                wait_until(lambda: (self.client.coalesced[name] - before
+                                    == self.nthreads - 1))
+                self.release.set()
+        assert len(self.urls) == 1
+        return futures
+
+    def test_find(self):
+        spec = {"outfields": ["md5sum"], "search": []}
+        rows = [{'PARAMETERS': {}}, {'md5sum': 'a'}, {'md5sum': 'b'}]
+        futures = self.run_all('find', self.client.find,
+                               json.dumps(rows).encode(),
+                               [spec] * self.nthreads)
+        results = [fut.result() for fut in futures]
+        assert self.client.coalesced['find'] == self.nthreads - 1
+        assert all(r == (rows[0], rows[1:]) for r in results)
+        # Every caller can change its rows without changing the others'
+        results[0][1].clear()
+        assert all(len(r[1]) == 2 for r in results[1:])
+        assert len({id(r[1]) for r in results}) == self.nthreads
+
+    def test_find_error(self):
+        """Every caller gets the error of the shared request"""
+        spec = {"outfields": ["md5sum"], "search": []}
+        futures = self.run_all('find', self.client.find,
+                               requests.ConnectionError('refused'),
+                               [spec] * self.nthreads)
+        for fut in futures:
+            assert isinstance(fut.exception(), requests.ConnectionError)
+
+    def test_retrieve(self):
+        """Others hardlink the file of the one download"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfiles = [os.path.join(tmpdir, f'foo{i}.fits')
+                        for i in range(self.nthreads)]
+            futures = self.run_all(
+                'retrieve', lambda f: self.client.retrieve('abc', f),
+                b'SIMPLE  =    T', outfiles)
+            assert all(fut.result() for fut in futures)
+            assert self.client.coalesced['retrieve'] == self.nthreads - 1
+            stats = [os.stat(f) for f in outfiles]
+            assert len({st.st_ino for st in stats}) == 1
+            assert stats[0].st_nlink == self.nthreads
+            assert Path(outfiles[-1]).read_bytes() == b'SIMPLE  =    T'
+            assert sorted(os.listdir(tmpdir)) == sorted(
+                os.path.basename(f) for f in outfiles)
+
+class HedgeTest(unittest.TestCase):
+    """Timeouts and hedging across two Servers (no Server)"""
+
+    urls = ['http://primary.test/', 'http://backup.test/']
+    rows = [{'PARAMETERS': {}}, {'md5sum': 'a'}]
+
+    def test_timeout(self):
+        """Connecting is limited by default, reading is not"""
+        client = offline_client()
+        with mock.patch('requests.request',
+                        return_value=response(b'6.0')) as request:
+            client._request('GET', f'{client.apiurl}/version/')
+        assert request.call_args.kwargs['timeout'] == (5, None)
+
+    def test_hedge(self):
+        """A slow find is resent to the backup, with a read timeout"""
+        client = offline_client(self.urls, hedge=True)
+        primary, backup = client.endpoints.endpoints
+        backup.record(elapsed=1.0)
+        for i in range(20):
+            primary.record(elapsed=0.001, op='find')
+        assert client.endpoints.ordered() == [primary, backup]
+        release = threading.Event()
+        timeouts = list()
+
+        def request(method, url, timeout=None, **kwargs):
+            timeouts.append(timeout)
+            if url.startswith(primary.rooturl):
+                release.wait(5)
+            return response(json.dumps(self.rows).encode())
+        with client, mock.patch('requests.request', side_effect=request):
+            info, rows = client.find({"outfields": ["md5sum"],
+                                      "search": []})
+            release.set()
+        assert rows == self.rows[1:]
+        assert timeouts == [(5, client.HEDGE_TIMEOUT)] * 2
+        assert client._hedge_pool is None  # closed
+
+    def test_hedge_count(self):
+        """Counts are hedged on the latency of counts, not of finds"""
+        client = offline_client(self.urls, hedge=True)
+        primary, backup = client.endpoints.endpoints
+        backup.record(elapsed=1.0)
+        for i in range(20):
+            primary.record(elapsed=0.001, op='find')
+        urls = list()
+
+        def request(method, url, **kwargs):
+            urls.append(url)
+            time.sleep(0.05)
+            return response(json.dumps([{}, {'count': 3}]).encode())
+        with client, mock.patch('requests.request', side_effect=request):
+            assert client.count({"outfields": ["md5sum"],
+                                 "search": []}) == 3
+        assert len(urls) == 1 and urls[0].startswith(primary.rooturl)
+        assert list(primary.samples['count']) >= [0.05]
+        assert primary.percentile(50, op='find') == 0.001
+
+class CountTest(unittest.TestCase):
+    """Cached counts (no Server)"""
+
+    jspecs = {inst: {"outfields": ["md5sum"],
+                     "search": [["instrument", inst]]}
+              for inst in ['decam', 'mosaic3', '90prime']}
+
+    def request(self, method, url, **kwargs):
+        """Fake Server: count is the length of the instrument name"""
+        self.requests.append(url)  # (append is thread safe)
+        count = len(kwargs['json']['search'][0][1])
+        return response(json.dumps([{}, {'count': count}]).encode())
+
+    def count_many(self, client):
+        self.requests = list()
+        with mock.patch('requests.request', side_effect=self.request):
+            return client.count_many(self.jspecs)
+
+    def test_count_many(self):
+        client = offline_client()
+        expected = {'decam': 5, 'mosaic3': 7, '90prime': 7}
+        assert self.count_many(client) == expected
+        assert len(self.requests) == 3
+        assert self.count_many(client) == expected
+        assert len(self.requests) == 0
+
+    def test_max_age_0(self):
+        """count_max_age=0 never reuses a count"""
+        client = offline_client(count_max_age=0)
+        self.count_many(client)
+        self.count_many(client)
+        assert len(self.requests) == 3
+
+    def test_expiry(self):
+        cache = _CountCache(max_age=60)
+        with mock.patch('time.time', return_value=1000.0):
+            cache.put('k', 5)
+            assert cache.get('k') == 5
+            assert cache.get('k', max_age=0) is None
+            assert cache.get('other') is None
+        with mock.patch('time.time', return_value=1059.0):
+            assert cache.get('k') == 5
+        with mock.patch('time.time', return_value=1060.0):
+            assert cache.get('k') is None
+            assert cache.get('k', max_age=61) == 5
+
+    def test_cachefile(self):
+        """Counts survive from one cache (process) to the next"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cachefile = os.path.join(tmpdir, 'counts.json')
+            _CountCache(cachefile=cachefile).put('k', 5)
+            cache = _CountCache(cachefile=cachefile)
+            assert cache.get('k') == 5
+            cache.clear()
+            assert not os.path.exists(cachefile)
+            assert _CountCache(cachefile=cachefile).get('k') is None
+            assert os.listdir(tmpdir) == []
+
+
+class PipelineTest(unittest.TestCase):
+    """Retrieve and process with a stub client (no Server)"""
+
+    def rows(self, n, size=100, **kwargs):
+        return [dict(md5sum=f'f{i}-{size}', n=i, **kwargs) for i in range(n)]
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+
+    def run_pipe(self, client, rows, **kwargs):
+        pipe = Pipeline(client, filesize, workdir=self.workdir.name,
+                        **kwargs)
+        out = list()
+        for row, result in pipe.run(rows):
+            client.delivered += 1
+            out.append((row, result))
+        return pipe, out
+
+    def test_disk_budget(self):
+        """Downloads wait while files not yet processed fill the budget"""
+        client = StubClient()
+        rows = self.rows(12, delay=0.05)
+        for row in rows:
+            row['filesize'] = 100
+        pipe, out = self.run_pipe(client, rows, downloads=4, processes=1,
+                                  queue_size=100, disk_budget=250)
+        assert sorted(result for row, result in out) == [100] * 12
+        assert 0 < pipe.stats['staged_max'] <= 250
+        assert pipe.stats['blocked'] > 0
+        assert os.listdir(self.workdir.name) == []
+
+    def test_queue_size(self):
+        """No more than QUEUE_SIZE + DOWNLOADS rows are ever in flight"""
+        client = StubClient()
+        pipe = Pipeline(client, filesize, downloads=2, processes=1,
+                        queue_size=3, workdir=self.workdir.name)
+        count = 0
+        for row, result in pipe.run(self.rows(20)):
+            client.delivered += 1
+            count += 1
+            time.sleep(0.02)  # slow consumer
+        assert count == 20
+        # Plus the one row on its way to the consumer
+        assert 3 + 2 <= client.ahead <= 3 + 2 + 1
+
+    def test_errors_yield(self):
+        """Failed downloads and FUNC calls are delivered as exceptions"""
+        client = StubClient(missing={'f1-100'})
+        rows = self.rows(4)
+        rows[2]['bad'] = True
+        pipe, out = self.run_pipe(client, rows, processes=1, ordered=True,
+                                  errors='yield')
+        results = [result for row, result in out]
+        assert results[0] == 100 and results[3] == 100
+        assert '404' in str(results[1])
+        assert isinstance(results[2], ValueError)
+
+    def test_errors_raise(self):
+        client = StubClient(missing={'f1-100'})
+        with self.assertRaisesRegex(Exception, '404'):
+            self.run_pipe(client, self.rows(4), processes=1)
+        assert os.listdir(self.workdir.name) == []
+
+    def test_stop_early(self):
+        """Consumer that stops early: feeding stops and files are removed"""
+        tmpdir = tempfile.gettempdir()
+        before = {f for f in os.listdir(tmpdir)
+                  if f.startswith('ada-pipeline-')}
+        client = StubClient()
+        pipe = Pipeline(client, filesize, downloads=2, processes=1,
+                        queue_size=2)
+        results = pipe.run(self.rows(100))
+        next(results)
+        results.close()
+        assert client.retrieved < 100
+        after = {f for f in os.listdir(tmpdir)
+                 if f.startswith('ada-pipeline-')}
+        assert after == before
+
+    def run_within(self, pipe, rows, timeout=30):
+        """List the results of PIPE.run(ROWS), failing (instead of
+        hanging) if they do not all arrive within TIMEOUT seconds."""
+        out = list()
+        thread = threading.Thread(target=lambda: out.extend(pipe.run(rows)),
+                                  daemon=True)
+        thread.start()
+        thread.join(timeout)
+        assert not thread.is_alive(), 'Pipeline.run did not return'
+        return out
+
+    def test_no_md5sum(self):
+        """A row without md5sum is delivered with its error"""
+        rows = [{'archive_filename': 'x'}] + self.rows(2)
+        pipe = Pipeline(StubClient(), filesize, processes=1, ordered=True,
+                        errors='yield', workdir=self.workdir.name)
+        out = self.run_within(pipe, rows)
+        assert isinstance(out[0][1], KeyError)
+        assert [result for row, result in out[1:]] == [100, 100]
+        assert pipe._staged == 0
+
+    def test_cleanup_error(self):
+        """A file that cannot be removed is an error of its row"""
+        pipe = Pipeline(StubClient(), filesize, processes=1, errors='yield',
+                        workdir=self.workdir.name)
+        with mock.patch('os.remove', side_effect=PermissionError('denied')):
+            out = self.run_within(pipe, self.rows(2))
+        assert [type(result) for row, result in out] == [PermissionError] * 2
+
+    def test_ordered(self):
+        """Results come in the order of the rows, not of completion"""
+        client = StubClient()
+        rows = self.rows(6)
+        for row in rows:
+            row['delay'] = 0.05 * (6 - row['n'])  # first row ends last
+        pipe, out = self.run_pipe(client, rows, downloads=6, processes=3,
+                                  ordered=True)
+        assert [row['n'] for row, result in out] == list(range(6))
+        assert pipe.stats['download']['count'] == 6
+
+class StubCliClient():
+    """Stands in for AdaClient in CLI tests"""
+
+    def __init__(self, rows=(), missing=()):
+        self.rows = list(rows)
+        self.missing = set(missing)
+        self.calls = list()
+        self.lock = threading.Lock()
+        self.retrieved = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def find_pages(self, jspec, **kwargs):
+        self.calls.append(('find_pages', jspec, kwargs))
+        for i in range(0, len(self.rows), 2):
+            yield {}, self.rows[i:i+2]
+
+    def count(self, jspec, rectype='file'):
+        self.calls.append(('count', jspec, dict(rectype=rectype)))
+        return 42
+
+    def retrieve(self, fileid, outfile, hdu=None):
+        time.sleep(0.001)
+        with self.lock:
+            self.retrieved += 1
+        if fileid in self.missing:
+            raise Exception('404 Not Found')
+        return True
+
+
+class TtyStringIO(StringIO):
+    def isatty(self):
+        return True
+
+
+class BrokenStdout():
+    """stdout of a pipe whose reader has gone (e.g. "| head -1")"""
+
+    def __init__(self, fileno):
+        self._fileno = fileno
+
+    def write(self, text):
+        raise BrokenPipeError(32, 'Broken pipe')
+
+    def flush(self):
+        pass
+
+    def fileno(self):
+        return self._fileno
+
+
+class CliTest(unittest.TestCase):
+    """"ada" command line (no Server)"""
+
+    spec = {"outfields": ["md5sum", "ra"], "search": [["instrument", "decam"]]}
+    rows = [dict(md5sum=f'm{i}', ra=i / 2) for i in range(5)]
+
+    def main(self, argv, stdin='', client=None):
+        """Run "ada ARGV". Returns exit status, stdout and stderr."""
+        self.client = client or StubCliClient(self.rows)
+        stdin = stdin if not isinstance(stdin, str) else StringIO(stdin)
+        stdout, stderr = StringIO(), StringIO()
+        with mock.patch('ada.cli._client', return_value=self.client), \
+             mock.patch('sys.stdin', stdin), \
+             mock.patch('sys.stdout', stdout), \
+             mock.patch('sys.stderr', stderr):
+            status = cli.main(argv)
+        return status, stdout.getvalue(), stderr.getvalue()
+
+    def test_find(self):
+        status, out, err = self.main(['find', '--limit', '5'],
+                                     stdin=json.dumps(self.spec))
+        assert status == 0 and err == ''
+        assert [json.loads(line) for line in out.splitlines()] == self.rows
+        name, jspec, kwargs = self.client.calls[0]
+        assert jspec == self.spec
+        assert kwargs['limit'] == 5 and kwargs['rectype'] == 'file'
+
+    def test_find_csv(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            json.dump(self.spec, f)
+            f.flush()
+            status, out, err = self.main(['find', f.name, '--format', 'csv'])
+        assert status == 0
+        assert out.splitlines() == ['md5sum,ra'] + [
+            f'{row["md5sum"]},{row["ra"]}' for row in self.rows]
+
+    def test_count(self):
+        status, out, err = self.main(['count', '--rectype', 'hdu'],
+                                     stdin=json.dumps(self.spec))
+        assert (status, out) == (0, '42\n')
+        assert self.client.calls == [('count', self.spec,
+                                      dict(rectype='hdu'))]
+
+    def test_no_spec(self):
+        """Never silently search the whole Archive"""
+        for command in ('find', 'count'):
+            status, out, err = self.main([command], stdin='  \n')
+            assert (status, out) == (1, '')
+            assert 'empty' in err
+            status, out, err = self.main([command], stdin=TtyStringIO())
+            assert status == 1 and 'No search spec' in err
+            assert self.client.calls == []
+
+    def test_broken_pipe(self):
+        """Reader of stdout went away: exit as if killed by SIGPIPE"""
+        with tempfile.TemporaryFile() as f:
+            with mock.patch('ada.cli._client',
+                            return_value=StubCliClient(self.rows)), \
+                 mock.patch('sys.stdin', StringIO(json.dumps(self.spec))), \
+                 mock.patch('sys.stdout', BrokenStdout(f.fileno())):
+                assert cli.main(['find']) == 141
+
+    def test_fetch(self):
+        """Read-ahead of md5sums on stdin is bounded by --jobs"""
+        client = StubCliClient(missing={'m7'})
+        ahead = list()
+
+        def md5sums():
+            for i in range(50):
+                ahead.append(i - client.retrieved)
+                yield f'm{i}  extra words\n' if i else '# comment\n'
+        with tempfile.TemporaryDirectory() as outdir:
+            status, out, err = self.main(
+                ['fetch', '-o', outdir, '-j', '2', '--suffix', '.fz'],
+                stdin=md5sums(), client=client)
+        assert status == 1
+        assert err.strip() == 'ERROR: m7: 404 Not Found'
+        assert sorted(out.splitlines()) == sorted(
+            os.path.join(outdir, f'm{i}.fz') for i in range(1, 50) if i != 7)
+        assert max(ahead) <= 2 * 2 + 1
+
+    def test_fetch_http_error(self):
+        """Through a real AdaClient: an HTTP error of a retrieve goes to
+        stderr, and stdout only ever has paths of files retrieved"""
+        proposals = {'locked': [{'proposal': '2020A-0001'}]}
+
+        def request(method, url, **kwargs):
+            if url.endswith('/version/'):
+                return response(b'6.0')
+            if '/find/' in url:
+                md5sum = kwargs['json']['search'][0][1]
+                return response(json.dumps(
+                    [{}] + proposals.get(md5sum, [])).encode())
+            md5sum = url.split('/retrieve/')[1].split('/')[0]
+            if md5sum == 'good':
+                return response(b'SIMPLE  =    T')
+            res = response(b'', 403 if md5sum in proposals else 404)
+            res.reason, res.url = 'Denied', url
+            return res
+        stdin = StringIO('deadbeef\ngood\nlocked\n')
+        stdout, stderr = StringIO(), StringIO()
+        with tempfile.TemporaryDirectory() as outdir, \
+             mock.patch('requests.request', side_effect=request), \
+             mock.patch('sys.stdin', stdin), \
+             mock.patch('sys.stdout', stdout), \
+             mock.patch('sys.stderr', stderr):
+            status = cli.main(['--url', 'http://archive.test/',
+                               'fetch', '-o', outdir, '-j', '1'])
+            assert os.listdir(outdir) == ['good.fits']
+            assert stdout.getvalue() == os.path.join(outdir,
+                                                     'good.fits') + '\n'
+        assert status == 1
+        errors = [line for line in stderr.getvalue().splitlines()
+                  if line.startswith('ERROR: ')]
+        assert errors == [
+            'ERROR: deadbeef: 404 Client Error: Denied for url: '
+            'http://archive.test/api/retrieve/deadbeef/',
+            'ERROR: locked: 403 Client Error: Denied for url: '
+            'http://archive.test/api/retrieve/locked/; Email=None must be '
+            'authorized for Proposal=2020A-0001']
+
+    def test_help(self):
+        """"--help" does not import "requests" (or contact a Server)"""
+        code = ('import sys\n'
+                'from ada import cli\n'
+                'try:\n'
+                '    cli.main(["--help"])\n'
+                'except SystemExit as err:\n'
+                '    assert err.code == 0\n'
+                'print("requests" in sys.modules)\n')
+        out = subprocess.run([sys.executable, '-c', code],
+                             stdout=subprocess.PIPE, check=True,
+                             cwd=Path(__file__).parent.parent).stdout
+        assert out.decode().splitlines()[-1] == 'False'
+
 ##############################################################################
 
 if __name__ == '__main__':